@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+#
+# Microbenchmark for the full request path of a /get API call: routing,
+# request validation, access check, DynamoDB lookup (against the fakes in
+# fakes.py) and response serialization. Runs offline, no AWS access needed.
+#
+#   python3 benchmarks/api_get.py [-n REQUESTS]
+#
+# For comparison it also measures the same requests with the router and
+# Actions built per request, like the handler did before they were hoisted.
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda', 'functions'))
+
+os.environ.update({
+  'AWS_DEFAULT_REGION':     'eu-west-1',
+  'ddb_tablename':          'addresses',
+  'sns_admin':              'arn:aws:sns:eu-west-1:123456789012:admin',
+  'email_domains':          '["vmail.example.com", "other.example.com"]',
+  'owner_domains':          '["example.com"]',
+  'recipient_domains':      '["example.com"]',
+  'restricted_access_keys': '{ "restricted": "other.example.com" }',
+  # No EMF lines on stdout
+  'metrics_namespace':      ''
+})
+
+import fakes
+_fakes = fakes.install(keynames={ 'addresses': 'virtualemail' })
+
+from anslapi import APIHandler
+from virtualmail import api
+from virtualmail.vmapi.actions import Actions, load_settings
+
+api.logger.disabled = True
+
+
+def make_event(address, apikeyid):
+  return {
+    'resource':       '/get',
+    'httpMethod':     'POST',
+    'body':           json.dumps({ 'virtualemail': address }),
+    'requestContext': { 'identity': { 'apiKeyId': apikeyid } }
+  }
+
+
+def per_request_setup(event, context):
+  # The request path before the router and Actions were hoisted
+  router = api.router
+  ah = APIHandler()
+  ac = Actions(load_settings(api.config), api.logger)
+  ah.add_handler('/get',    'POST', ac.get)
+  ah.add_handler('/add',    'POST', ac.add)
+  ah.add_handler('/delete', 'POST', ac.delete)
+  ah.add_handler('/modify', 'POST', ac.modify)
+  api.router = ah
+  try:
+    return api.lambda_handler(event, context)
+  finally:
+    api.router = router
+
+
+def run(handler, events, n):
+  timings = []
+  for i in range(n):
+    event = events[i % len(events)]
+    t = time.perf_counter()
+    response = handler(event, None)
+    timings.append(time.perf_counter() - t)
+    if response['statusCode'] != 200:
+      raise Exception("Unexpected response {}".format(response))
+  return timings
+
+
+def report(name, timings):
+  timings = sorted(timings)
+  print("{:<22} mean {:7.1f} us  p50 {:7.1f} us  p99 {:7.1f} us  ({:.0f} req/s)".format(
+    name,
+    statistics.mean(timings) * 1e6,
+    timings[len(timings) // 2] * 1e6,
+    timings[int(len(timings) * 0.99)] * 1e6,
+    len(timings) / sum(timings)
+  ))
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('-n', type=int, default=20000, help="number of requests")
+  args = parser.parse_args()
+
+  table = _fakes.dynamodb.Table('addresses')
+  for i in range(100):
+    address = 'account{}@vmail.example.com'.format(i)
+    table.items[address] = {
+      'virtualemail': address,
+      'owner':        'owner@example.com',
+      'recipients':   '["team@example.com"]',
+      'protected':    False,
+      'managed':      True
+    }
+
+  # Existing, nonexistent and forbidden addresses, with and without a
+  # restricted api key
+  events = []
+  for i in range(100):
+    events.append(make_event('account{}@vmail.example.com'.format(i), 'unrestricted'))
+    events.append(make_event('missing{}@vmail.example.com'.format(i), 'unrestricted'))
+    events.append(make_event('account{}@vmail.example.com'.format(i), 'restricted'))
+
+  run(api.lambda_handler, events, 1000)
+  report("hoisted", run(api.lambda_handler, events, args.n))
+  report("per request setup", run(per_request_setup, events, args.n))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,197 @@
+#
+# In-process stand-ins for the AWS services used by virtualmail, for the
+# offline benchmarks. They implement only the calls and parameters the
+# code base uses; write conditions are not evaluated, so benchmarks must
+# use keys that make every condition pass. Every call sleeps for the
+# configured latency of its service to model the network round trip.
+#
+# install() puts them into the virtualmail.common.clients registry; it has
+# to be called before the entry point modules are imported.
+
+import io
+import random
+import threading
+import time
+import uuid
+
+
+class Latency(object):
+  # Per service latency in milliseconds, with optional uniform jitter
+  def __init__(self, latencies=None, jitter=0.0):
+    self.latencies = latencies or {}
+    self.jitter    = jitter
+
+  def wait(self, service):
+    ms = self.latencies.get(service, 0)
+    if ms <= 0:
+      return
+    time.sleep(max(ms + random.uniform(-self.jitter, self.jitter), 0) / 1000)
+
+
+def _key(keyname, item):
+  if isinstance(keyname, str):
+    return item[keyname]
+  return tuple([ item[x] for x in keyname ])
+
+
+class FakeTable(object):
+  # boto3 Table
+  def __init__(self, name, keyname, latency):
+    self.name    = name
+    self.keyname = keyname
+    self.latency = latency
+    self.items   = {}
+    self._lock   = threading.Lock()
+
+  def _k(self, key):
+    return key[self.keyname] if isinstance(self.keyname, str) else _key(self.keyname, key)
+
+  def get_item(self, Key, **kwargs):
+    self.latency.wait('dynamodb')
+    item = self.items.get(self._k(Key))
+    return { 'Item': dict(item) } if item is not None else {}
+
+  def put_item(self, Item, **kwargs):
+    self.latency.wait('dynamodb')
+    with self._lock:
+      self.items[self._k(Item)] = dict(Item)
+    return {}
+
+  def update_item(self, Key, **kwargs):
+    # Only records the write, the update expression is not applied
+    self.latency.wait('dynamodb')
+    return {}
+
+  def delete_item(self, Key, **kwargs):
+    self.latency.wait('dynamodb')
+    with self._lock:
+      self.items.pop(self._k(Key), None)
+    return {}
+
+
+class FakeDynamoDB(object):
+  # boto3 DynamoDB service resource
+  def __init__(self, latency, keynames):
+    self.latency  = latency
+    self.keynames = keynames
+    self.tables   = {}
+    self._lock    = threading.Lock()
+
+  def Table(self, name):
+    with self._lock:
+      if name not in self.tables:
+        self.tables[name] = FakeTable(name, self.keynames.get(name, 'id'), self.latency)
+      return self.tables[name]
+
+  def batch_get_item(self, RequestItems):
+    self.latency.wait('dynamodb')
+    responses = {}
+    for name, request in RequestItems.items():
+      table = self.Table(name)
+      responses[name] = [
+        dict(table.items[table._k(key)]) for key in request['Keys']
+        if table._k(key) in table.items
+      ]
+    return { 'Responses': responses, 'UnprocessedKeys': {} }
+
+  def batch_write_item(self, RequestItems):
+    self.latency.wait('dynamodb')
+    for name, requests in RequestItems.items():
+      table = self.Table(name)
+      with table._lock:
+        for x in requests:
+          if 'PutRequest' in x:
+            item = x['PutRequest']['Item']
+            table.items[table._k(item)] = dict(item)
+          else:
+            table.items.pop(table._k(x['DeleteRequest']['Key']), None)
+    return { 'UnprocessedItems': {} }
+
+
+class FakeDDBTable(object):
+  # anawsutils.dynamodb.Table
+  def __init__(self, table):
+    self.table = table
+
+  def get_item(self, keyname, key):
+    return self.table.get_item(Key={ keyname: key }).get('Item')
+
+
+class FakeDDB(object):
+  # anawsutils.dynamodb.DDB
+  def __init__(self, resource):
+    self.dynamodb = resource
+    self.tables   = {}
+
+  def get_table(self, tablename):
+    if tablename not in self.tables:
+      self.tables[tablename] = FakeDDBTable(self.dynamodb.Table(tablename))
+    return self.tables[tablename]
+
+  def get_item(self, ddb_tablename, keyname, key):
+    return self.get_table(ddb_tablename).get_item(keyname, key)
+
+
+class FakeSNS(object):
+  # anawsutils.sns.SNS
+  def __init__(self, latency):
+    self.latency   = latency
+    self.published = 0
+
+  def send_sns(self, arn, subject, message):
+    self.latency.wait('sns')
+    self.published += 1
+    return { 'MessageId': str(uuid.uuid4()) }
+
+
+class FakeS3(object):
+  # boto3 S3 client
+  def __init__(self, latency):
+    self.latency = latency
+    self.objects = {}
+
+  def put(self, bucket, key, data):
+    self.objects[(bucket, key)] = data
+
+  def get_object(self, Bucket, Key, **kwargs):
+    self.latency.wait('s3')
+    return { 'Body': io.BytesIO(self.objects[(Bucket, Key)]) }
+
+
+class FakeSES(object):
+  # boto3 SES client
+  def __init__(self, latency):
+    self.latency = latency
+    self.sent    = 0
+    self.bytes   = 0
+    self._lock   = threading.Lock()
+
+  def send_raw_email(self, RawMessage, **kwargs):
+    self.latency.wait('ses')
+    with self._lock:
+      self.sent += 1
+      self.bytes += len(RawMessage['Data'])
+    return { 'MessageId': str(uuid.uuid4()) }
+
+
+class Fakes(object):
+  def __init__(self, latency, keynames):
+    self.dynamodb = FakeDynamoDB(latency, keynames)
+    self.ddb      = FakeDDB(self.dynamodb)
+    self.sns      = FakeSNS(latency)
+    self.s3       = FakeS3(latency)
+    self.ses      = FakeSES(latency)
+
+
+def install(latency=None, keynames=None):
+  # keynames maps table names to their key attribute (or list of key
+  # attributes), tables not listed are keyed by 'id'
+  from virtualmail.common import clients
+
+  fakes = Fakes(latency or Latency(), keynames or {})
+  clients._resources['dynamodb'] = fakes.dynamodb
+  clients._clients['s3']         = fakes.s3
+  clients._clients['ses']        = fakes.ses
+  clients._ddb                   = fakes.ddb
+  clients._sns                   = fakes.sns
+  return fakes
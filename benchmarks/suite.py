@@ -0,0 +1,470 @@
+#!/usr/bin/env python3
+#
+# Offline benchmark suite. Drives handler, gatekeeper and api
+# lambda_handler with generated SNS, SQS, SES and API Gateway events
+# against the in-process fakes in fakes.py, and reports per scenario:
+#
+#   - throughput (records and message megabytes per second)
+#   - invocation latency percentiles
+#   - per-stage latency percentiles, taken from the EMF metric lines the
+#     entry points emit (see virtualmail/common/metrics.py)
+#   - peak RSS of the process that ran the scenario
+#
+# Each scenario runs in a forked child process, so that peak RSS and
+# caches are per scenario. Results can be saved with --json and compared
+# with an earlier run with --compare.
+#
+#   python3 benchmarks/suite.py
+#   python3 benchmarks/suite.py --only handler-sns --sizes 1k,10m --latency s3=20,ses=40
+#   python3 benchmarks/suite.py --json before.json
+#   python3 benchmarks/suite.py --compare before.json
+
+import argparse
+import base64
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda', 'functions'))
+
+import fakes
+
+DOMAIN = 'bench.example.com'
+BUCKET = 'bench-incoming'
+
+ENVIRONMENT = {
+  'AWS_DEFAULT_REGION': 'eu-west-1',
+  'ddb_tablename':      'addresses',
+  'ddb_tablename_log':  'logs',
+  'ddb_tablename_sent': 'sent',
+  'sns_admin':          'arn:aws:sns:eu-west-1:123456789012:admin',
+  'email_domains':      json.dumps([ DOMAIN ]),
+  'bounces_email':      json.dumps({ '%': 'bounces@' + DOMAIN }),
+  'default_sender':     json.dumps({ '%': 'sender@' + DOMAIN }),
+  'owner_domains':      json.dumps([ 'example.org' ]),
+  'recipient_domains':  json.dumps([ 'example.org' ]),
+  'print_mail_info':    ''
+}
+
+KEYNAMES = {
+  'addresses': 'virtualemail'
+}
+
+# Messages of a scenario are capped to this many bytes in total
+MAX_SCENARIO_BYTES = 512 * 1024 * 1024
+
+# SQS messages can not be larger than this
+MAX_SQS_SIZE = 256 * 1024
+
+# Largest message SES delivers inside an SNS action notification
+MAX_INLINE_SIZE = 150 * 1024
+
+SIZES = { 'k': 1024, 'm': 1024 * 1024 }
+
+
+def parse_size(s):
+  s = s.strip().lower()
+  if s[-1:] in SIZES:
+    return int(float(s[:-1]) * SIZES[s[-1]])
+  return int(s)
+
+
+def format_size(n):
+  for suffix, size in sorted(SIZES.items(), key=lambda x: -x[1]):
+    if n >= size and n % size == 0:
+      return '{}{}'.format(n // size, suffix)
+  return str(n)
+
+
+def parse_list(s, parse=int):
+  return [ parse(x) for x in s.split(',') if len(x.strip()) > 0 ]
+
+
+def parse_latency(s):
+  latencies = {}
+  for x in parse_list(s, str):
+    service, ms = x.split('=')
+    latencies[service.strip()] = float(ms)
+  return latencies
+
+
+def percentile(values, p):
+  if len(values) == 0:
+    return None
+  values = sorted(values)
+  return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+##############################################################################
+
+def make_message(size):
+  # A plain text message with a base64 body, padded to size bytes
+  header = (
+    'Received: from mail.example.net (mail.example.net [192.0.2.1])\r\n'
+    'DKIM-Signature: v=1; a=rsa-sha256; d=example.net; s=bench; b=' + 'A' * 344 + '\r\n'
+    'From: Sender <sender@example.net>\r\n'
+    'To: list@' + DOMAIN + '\r\n'
+    'Subject: Benchmark message\r\n'
+    'Date: Mon, 1 Jan 2024 00:00:00 +0000\r\n'
+    'Message-ID: <bench@example.net>\r\n'
+    'MIME-Version: 1.0\r\n'
+    'Content-Type: text/plain; charset=utf-8\r\n'
+    'Content-Transfer-Encoding: base64\r\n'
+    '\r\n'
+  ).encode()
+
+  line = base64.b64encode(bytes(range(57))) + b'\r\n'
+  lines = max(size - len(header), 0) // len(line) + 1
+  return (header + line * lines)[:max(size, len(header) + 2)]
+
+
+def vmail(fanout):
+  return 'list{}@{}'.format(fanout, DOMAIN)
+
+
+def add_addresses(ddb_fakes, fanouts):
+  table = ddb_fakes.dynamodb.Table('addresses')
+  for fanout in fanouts:
+    table.items[vmail(fanout)] = {
+      'virtualemail': vmail(fanout),
+      'vmail_domain': DOMAIN,
+      'owner':        'owner@example.org',
+      'recipients':   json.dumps([ 'user{}@example.org'.format(i) for i in range(fanout) ]),
+      'protected':    False,
+      'managed':      True
+    }
+
+
+def sns_event(i, destinations, size, inline=False):
+  msg = {
+    'mail': {
+      'messageId':     'bench-{}-{}'.format(os.getpid(), i),
+      'source':        'sender@example.net',
+      'destination':   destinations,
+      'commonHeaders': {
+        'subject': 'Benchmark message',
+        'to':      destinations,
+        'from':    [ 'Sender <sender@example.net>' ],
+        'date':    'Mon, 1 Jan 2024 00:00:00 +0000'
+      }
+    },
+    'receipt': {
+      'action': {
+        'type':       'S3',
+        'bucketName': BUCKET,
+        'objectKey':  'incoming/{}'.format(format_size(size))
+      }
+    }
+  }
+  if inline:
+    # SNS action notification, the content comes with it
+    msg['receipt']['action'] = { 'type': 'SNS', 'encoding': 'BASE64' }
+    msg['content'] = base64.b64encode(make_message(size)).decode()
+  return { 'Records': [ { 'EventSource': 'aws:sns', 'Sns': { 'Message': json.dumps(msg) } } ] }
+
+
+def sqs_event(i, batch, destination, body):
+  return { 'Records': [
+    {
+      'eventSource': 'aws:sqs',
+      'messageId':   'bench-{}-{}-{}'.format(os.getpid(), i, j),
+      'body':        json.dumps({
+        'to':      destination,
+        'from':    'sender@example.net',
+        'subject': 'Benchmark message',
+        'body':    body
+      })
+    }
+    for j in range(batch)
+  ] }
+
+
+def ses_event(destinations):
+  return { 'Records': [ { 'ses': { 'mail': {
+    'source':        'sender@example.net',
+    'destination':   destinations,
+    'commonHeaders': { 'subject': 'Benchmark message' }
+  } } } ] }
+
+
+def api_event(resource, body):
+  return {
+    'resource':       resource,
+    'httpMethod':     'POST',
+    'body':           json.dumps(body),
+    'requestContext': { 'identity': { 'apiKeyId': 'bench' } }
+  }
+
+
+##############################################################################
+
+class Scenario(object):
+  # events(i) returns the events of iteration i (usually one) and how many
+  # records and message bytes they carry
+  def __init__(self, name, module, events, iterations, setup=None):
+    self.name       = name
+    self.module     = module
+    self.events     = events
+    self.iterations = iterations
+    self.setup      = setup
+
+
+def get_scenarios(args):
+  sizes = parse_list(args.sizes, parse_size)
+  fanouts = parse_list(args.fanouts)
+  batches = parse_list(args.batches)
+
+  def iterations(size):
+    return max(3, min(args.iterations, MAX_SCENARIO_BYTES // max(size, 1)))
+
+  scenarios = []
+
+  for size in sizes:
+    for fanout in fanouts:
+      def setup(f, size=size):
+        f.s3.put(BUCKET, 'incoming/{}'.format(format_size(size)), make_message(size))
+
+      scenarios.append(Scenario(
+        'handler-sns size={} fanout={}'.format(format_size(size), fanout),
+        'handler',
+        lambda i, size=size, fanout=fanout: ([ sns_event(i, [ vmail(fanout) ], size) ], 1, size),
+        iterations(size),
+        setup
+      ))
+
+  for size in [ x for x in sizes if x <= MAX_INLINE_SIZE ]:
+    for fanout in fanouts:
+      scenarios.append(Scenario(
+        'handler-sns-inline size={} fanout={}'.format(format_size(size), fanout),
+        'handler',
+        lambda i, size=size, fanout=fanout: ([ sns_event(i, [ vmail(fanout) ], size, True) ], 1, size),
+        iterations(size)
+      ))
+
+  for size in [ x for x in sizes if x <= MAX_SQS_SIZE ]:
+    body = make_message(size).decode()
+    for fanout in fanouts:
+      for batch in batches:
+        scenarios.append(Scenario(
+          'handler-sqs size={} fanout={} batch={}'.format(format_size(size), fanout, batch),
+          'handler',
+          lambda i, fanout=fanout, batch=batch, body=body, size=size: (
+            [ sqs_event(i, batch, vmail(fanout), body) ], batch, size * batch
+          ),
+          iterations(size * batch)
+        ))
+
+  for fanout in fanouts:
+    # Half of the destinations exist
+    destinations = [
+      vmail(fanouts[0]) if i % 2 == 0 else 'missing{}@{}'.format(i, DOMAIN)
+      for i in range(fanout)
+    ]
+    scenarios.append(Scenario(
+      'gatekeeper destinations={}'.format(fanout),
+      'gatekeeper',
+      lambda i, destinations=destinations: ([ ses_event(destinations) ], 1, 0),
+      args.iterations
+    ))
+
+  scenarios.append(Scenario(
+    'api /get',
+    'api',
+    lambda i: ([ api_event('/get', { 'virtualemail': vmail(fanouts[0]) }) ], 1, 0),
+    args.iterations
+  ))
+  scenarios.append(Scenario(
+    'api /get missing',
+    'api',
+    lambda i: ([ api_event('/get', { 'virtualemail': 'missing{}@{}'.format(i, DOMAIN) }) ], 1, 0),
+    args.iterations
+  ))
+  scenarios.append(Scenario(
+    'api /add + /delete',
+    'api',
+    lambda i: ([
+      api_event('/add', {
+        'virtualemail': 'new{}@{}'.format(i, DOMAIN),
+        'owner':        'owner@example.org',
+        'recipients':   json.dumps([ 'user1@example.org', 'user2@example.org' ])
+      }),
+      api_event('/delete', {
+        'virtualemail': 'new{}@{}'.format(i, DOMAIN),
+        'owner':        'owner@example.org'
+      })
+    ], 2, 0),
+    args.iterations
+  ))
+  for fanout in fanouts:
+    scenarios.append(Scenario(
+      'api /batch-get keys={}'.format(fanout),
+      'api',
+      lambda i, fanout=fanout: ([ api_event('/batch-get', {
+        'virtualemails': [ vmail(fanouts[j % len(fanouts)]) for j in range(fanout) ]
+      }) ], 1, 0),
+      args.iterations
+    ))
+
+  if args.only is not None:
+    scenarios = [ x for x in scenarios if any([ y in x.name for y in args.only ]) ]
+
+  return scenarios
+
+
+##############################################################################
+
+def check_result(module, result):
+  # Fails the scenario if the entry point reported an error
+  if module == 'handler' and len(result['batchItemFailures']) > 0:
+    raise Exception("Handler reported failures: {}".format(result))
+  if module == 'api':
+    if result['statusCode'] != 200 or json.loads(result['body']).get('status') == 'FAIL':
+      raise Exception("API request failed: {}".format(result))
+
+
+def run_scenario(index):
+  # Runs in a forked child with the fakes, entry points and scenarios
+  # already loaded; only the index is passed as scenarios are not picklable
+  scenario = _scenarios[index]
+  from virtualmail.common import metrics
+  from virtualmail import api, gatekeeper, handler
+
+  modules = { 'api': api, 'gatekeeper': gatekeeper, 'handler': handler }
+  module = modules[scenario.module]
+
+  if scenario.setup is not None:
+    scenario.setup(_fakes)
+
+  lines = []
+  metrics._write = lambda line: lines.append(json.loads(line))
+
+  # One untimed round so that lazily created state is in place
+  for event in scenario.events(-1)[0]:
+    check_result(scenario.module, module.lambda_handler(event, None))
+  del lines[:]
+
+  latencies = []
+  records = 0
+  size = 0
+  started = time.perf_counter()
+  for i in range(scenario.iterations):
+    events, _records, _size = scenario.events(i)
+    for event in events:
+      t = time.perf_counter()
+      result = module.lambda_handler(event, None)
+      latencies.append((time.perf_counter() - t) * 1000)
+      check_result(scenario.module, result)
+    records += _records
+    size += _size
+  elapsed = time.perf_counter() - started
+
+  stages = {}
+  for line in lines:
+    for x in line['_aws']['CloudWatchMetrics'][0]['Metrics']:
+      if x['Unit'] == metrics.MILLISECONDS:
+        stages.setdefault(x['Name'], []).append(line[x['Name']])
+
+  return {
+    'name':        scenario.name,
+    'invocations': len(latencies),
+    'records':     records,
+    'seconds':     elapsed,
+    'records_s':   records / elapsed,
+    'mb_s':        size / elapsed / 1024 / 1024,
+    'latency':     { str(p): percentile(latencies, p) for p in (50, 90, 99) },
+    'stages':      {
+      k: { str(p): percentile(v, p) for p in (50, 90, 99) } for k, v in stages.items()
+    },
+    'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+  }
+
+
+def print_result(r, baseline=None):
+  print('{name}\n  {invocations} invocations, {records} records in {seconds:.2f} s: '
+        '{records_s:.1f} records/s, {mb_s:.2f} MB/s, peak RSS {peak_rss_mb:.1f} MB'.format(**r))
+
+  def row(name, p, base=None):
+    s = '    {:<14} p50 {:9.3f}  p90 {:9.3f}  p99 {:9.3f} ms'.format(name, p['50'], p['90'], p['99'])
+    if base is not None:
+      s += '  (p50 {:+.1f}%, p99 {:+.1f}%)'.format(
+        (p['50'] / base['50'] - 1) * 100 if base['50'] else 0,
+        (p['99'] / base['99'] - 1) * 100 if base['99'] else 0
+      )
+    return s
+
+  print(row('invocation', r['latency'], baseline['latency'] if baseline else None))
+  for k, p in r['stages'].items():
+    base = baseline['stages'].get(k) if baseline else None
+    print(row(k, p, base))
+
+  if baseline is not None:
+    print('    throughput {:+.1f}%, peak RSS {:+.1f} MB'.format(
+      (r['records_s'] / baseline['records_s'] - 1) * 100,
+      r['peak_rss_mb'] - baseline['peak_rss_mb']
+    ))
+
+
+_fakes = None
+_scenarios = []
+
+
+def main():
+  global _fakes, _scenarios
+
+  parser = argparse.ArgumentParser(description="Offline virtualmail benchmarks")
+  parser.add_argument('--sizes', default='1k,100k,1m,10m', help="message sizes, e.g. 1k,10m")
+  parser.add_argument('--fanouts', default='1,10,50', help="recipients per vmail")
+  parser.add_argument('--batches', default='1,10', help="SQS records per invocation")
+  parser.add_argument('--iterations', type=int, default=100, help="invocations per scenario")
+  parser.add_argument('--latency', default='', help="injected latency in ms, e.g. dynamodb=5,s3=20,ses=40,sns=20")
+  parser.add_argument('--jitter', type=float, default=0, help="uniform latency jitter in ms")
+  parser.add_argument('--concurrency', type=int, default=1, help="handler_concurrency")
+  parser.add_argument('--only', action='append', help="run the scenarios whose name contains this")
+  parser.add_argument('--json', help="write the results to this file")
+  parser.add_argument('--compare', help="compare with the results in this file")
+  args = parser.parse_args()
+
+  os.environ.update(ENVIRONMENT)
+  os.environ['handler_concurrency'] = str(args.concurrency)
+
+  _fakes = fakes.install(fakes.Latency(parse_latency(args.latency), args.jitter), KEYNAMES)
+  add_addresses(_fakes, parse_list(args.fanouts))
+
+  # The entry points are imported once here and inherited by the children
+  from virtualmail import api, gatekeeper, handler
+  logging.disable(logging.CRITICAL)
+
+  baseline = {}
+  if args.compare is not None:
+    with open(args.compare) as f:
+      baseline = { x['name']: x for x in json.load(f)['results'] }
+
+  results = []
+  context = multiprocessing.get_context('fork')
+  _scenarios = get_scenarios(args)
+  for index in range(len(_scenarios)):
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+      r = executor.submit(run_scenario, index).result()
+    print_result(r, baseline.get(r['name']))
+    results.append(r)
+
+  if args.json is not None:
+    with open(args.json, 'w') as f:
+      json.dump({
+        'time':    time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python':  platform.python_version(),
+        'args':    vars(args),
+        'results': results
+      }, f, indent=2)
+
+
+if __name__ == '__main__':
+  main()
@@ -2,5 +2,7 @@ __all__ = [
     "api",
     "default", 
     "gatekeeper",
-    "handler"
+    "handler",
+    "reindex",
+    "snapshot"
 ]
\ No newline at end of file
@@ -1,9 +1,17 @@
-from .vmapi.actions import Actions
+from .common import startup
+from .common import utils
+from .common.metrics import BYTES, Metrics
+from .common.warmup import is_warmup, warm_up
+from .vmapi.actions import Actions, load_settings
+startup.mark('virtualmail.common')
 
 from anslapi import APIHandler
+startup.mark('anslapi')
+
 from anlogger import Logger
 _logger = Logger("virtualmail-api", 'INFO')
 logger = _logger.get()
+startup.mark('anlogger')
 
 from anenvconf import Config, ConfigValueType
 config_schema = {
@@ -11,6 +19,9 @@ config_schema = {
     'type': ConfigValueType.JSON      
   },
   'ddb_tablename': {},
+  'ddb_tablename_reverse': {
+    'default': ''
+  },
   'sns_admin': {},
   'owner_domains': {
     'type': ConfigValueType.JSON
@@ -25,22 +36,43 @@ config_schema = {
 }
 
 config = Config(config_schema)
+startup.mark('config')
+
+# The router, the configuration and Actions are set up once per container;
+# only the api key changes between requests and Actions reads it from the 
+# event
+actions = Actions(load_settings(config), logger)
+
+router = APIHandler()
+router.add_handler('/get',       'POST', actions.get)
+router.add_handler('/add',       'POST', actions.add)
+router.add_handler('/delete',    'POST', actions.delete)
+router.add_handler('/modify',    'POST', actions.modify)
+router.add_handler('/batch-get', 'POST', actions.batch_get)
+router.add_handler('/batch-add', 'POST', actions.batch_add)
+router.add_handler('/list',      'POST', actions.list)
+router.add_handler('/reverse',   'POST', actions.reverse)
 
 
 def lambda_handler(event, context):
-  
-  apikeyid = event['requestContext']['identity']['apiKeyId']
+  startup.report(logger)
+  if is_warmup(event):
+    return warm_up(logger, event, [ 'dynamodb', 'sns' ])
+
+  apikeyid = Actions.get_apikeyid(event)
   logger.info("apikeyid={}".format(apikeyid))
 
-  ah = APIHandler()
-  ac = Actions(config, apikeyid, logger)
-  
-  ah.add_handler('/get',    'POST', ac.get)
-  ah.add_handler('/add',    'POST', ac.add)
-  ah.add_handler('/delete', 'POST', ac.delete)
-  ah.add_handler('/modify', 'POST', ac.modify)
-  
-  response = ah.handle(event)
+  metrics = Metrics('api', { 'Resource': str(event.get('resource')) })
+  metrics.set_property('apikeyid', apikeyid)
+  metrics.add('request_size', len(event.get('body') or ''), BYTES)
+
+  with metrics.timer('total'):
+    response = router.handle(event)
+  utils.flush_errors()
+
+  metrics.add('response_size', len(response.get('body') or ''), BYTES)
+  metrics.set_property('status_code', response.get('statusCode'))
+  metrics.emit()
     
   logger.info(response) 
   return response
@@ -1,4 +1,15 @@
 __all__ = [
+    "addresses",
+    "batch",
+    "clients",
+    "errors",
     "exceptions",
-    "utils"
+    "logwriter",
+    "matchers",
+    "metrics",
+    "routing",
+    "snapshot",
+    "startup",
+    "utils",
+    "warmup"
 ]
\ No newline at end of file
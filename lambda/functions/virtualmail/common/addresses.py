@@ -0,0 +1,93 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+from .batch import batch_get_items
+
+
+class AddressCache(object):
+  # Bounded LRU cache that lives across warm invocations. With a negative_ttl
+  # addresses that do not exist are cached as None so that repeated lookups
+  # of nonexistent addresses do not hit DynamoDB either; a just created
+  # address then stays unknown until the entry expires.
+  def __init__(self, max_size=1024, ttl=60, negative_ttl=0):
+    self.max_size     = max_size
+    self.ttl          = ttl
+    self.negative_ttl = negative_ttl
+    self._items       = OrderedDict()
+    self._lock        = threading.Lock()
+
+
+  def get(self, key):
+    # Returns a (hit, item) tuple as None is a valid cached item
+    with self._lock:
+      if key not in self._items:
+        return (False, None)
+
+      expires, item = self._items[key]
+      if expires < time.monotonic():
+        del self._items[key]
+        return (False, None)
+
+      self._items.move_to_end(key)
+      return (True, item)
+
+
+  def put(self, key, item):
+    ttl = self.ttl if item is not None else self.negative_ttl
+    if self.max_size <= 0 or ttl <= 0:
+      return
+
+    with self._lock:
+      self._items[key] = (time.monotonic() + ttl, item)
+      self._items.move_to_end(key)
+      while len(self._items) > self.max_size:
+        self._items.popitem(last=False)
+
+
+class AddressBook(object):
+  def __init__(self, ddb, tablename, keyname='virtualemail', cache=None):
+    self.ddb       = ddb
+    self.tablename = tablename
+    self.keyname   = keyname
+    self.cache     = cache
+    self._items    = {}
+
+
+  def _from_cache(self, key):
+    if self.cache is None:
+      return False
+
+    hit, item = self.cache.get(key)
+    if hit is True:
+      self._items[key] = item
+    return hit
+
+
+  def _store(self, key, item):
+    self._items[key] = item
+    if self.cache is not None:
+      self.cache.put(key, item)
+
+
+  def prefetch(self, addresses):
+    keys = list(dict.fromkeys([ x.lower() for x in addresses ]))
+    missing = [ 
+      key for key in keys 
+      if key not in self._items and self._from_cache(key) is False 
+    ]
+
+    if len(missing) > 0:
+      r = batch_get_items(self.ddb, self.tablename, self.keyname, missing)
+      for key, item in r.items():
+        self._store(key, item)
+
+    return { key: self._items[key] for key in keys if key in self._items }
+
+
+  def get(self, address):
+    key = address.lower()
+    if key not in self._items and self._from_cache(key) is False:
+      self._store(key, self.ddb.get_item(self.tablename, self.keyname, key))
+    return self._items[key]
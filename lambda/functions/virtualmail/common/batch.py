@@ -0,0 +1,103 @@
+import time
+
+# DynamoDB BatchGetItem accepts at most 100 keys per call
+BATCH_GET_MAX_KEYS = 100
+
+
+def batch_get_items(ddb, tablename, keyname, keys, max_attempts=5, backoff=0.05):
+  # Returns { key: item } for every key that could be resolved; keys that
+  # do not exist map to None and keys that stayed unprocessed after all
+  # attempts are left out of the result
+  pending = list(dict.fromkeys(keys))
+  result  = {}
+  attempt = 0
+
+  while len(pending) > 0 and attempt < max_attempts:
+    if attempt > 0:
+      time.sleep(backoff * (2 ** (attempt - 1)))
+    attempt += 1
+
+    unprocessed = []
+    for i in range(0, len(pending), BATCH_GET_MAX_KEYS):
+      chunk = pending[i:i + BATCH_GET_MAX_KEYS]
+      response = ddb.dynamodb.batch_get_item(
+        RequestItems={
+          tablename: { 'Keys': [ { keyname: key } for key in chunk ] }
+        }
+      )
+
+      for item in response['Responses'].get(tablename, []):
+        result[item[keyname]] = item
+
+      _unprocessed = response.get('UnprocessedKeys', {}).get(tablename, {})
+      for x in _unprocessed.get('Keys', []):
+        unprocessed.append(x[keyname])
+
+      for key in chunk:
+        if key not in result and key not in unprocessed:
+          result[key] = None
+
+    pending = unprocessed
+
+  return result
+
+
+# DynamoDB BatchWriteItem accepts at most 25 items per call
+BATCH_WRITE_MAX_ITEMS = 25
+
+
+def _key(item, keyname):
+  if isinstance(keyname, str):
+    return item[keyname]
+  return tuple([ item[x] for x in keyname ])
+
+
+def _batch_write(ddb, tablename, requests, max_attempts, backoff):
+  # Sends the write requests in chunks of 25 and retries unprocessed 
+  # requests with exponential backoff; returns the requests that stayed
+  # unprocessed
+  pending = requests
+  attempt = 0
+
+  while len(pending) > 0 and attempt < max_attempts:
+    if attempt > 0:
+      time.sleep(backoff * (2 ** (attempt - 1)))
+    attempt += 1
+
+    unprocessed = []
+    for i in range(0, len(pending), BATCH_WRITE_MAX_ITEMS):
+      chunk = pending[i:i + BATCH_WRITE_MAX_ITEMS]
+      response = ddb.dynamodb.batch_write_item(RequestItems={ tablename: chunk })
+      unprocessed += response.get('UnprocessedItems', {}).get(tablename, [])
+
+    pending = unprocessed
+
+  return pending
+
+
+def batch_write_items(ddb, tablename, items, keyname='id', max_attempts=5, backoff=0.05):
+  # Puts the items and returns the ones that stayed unprocessed. A batch
+  # may not contain the same key twice, the last item for a key wins; 
+  # keyname is a list of attribute names for tables with a range key.
+  pending = list({ _key(item, keyname): item for item in items }.values())
+  unprocessed = _batch_write(
+    ddb, 
+    tablename, 
+    [ { 'PutRequest': { 'Item': item } } for item in pending ],
+    max_attempts,
+    backoff
+  )
+  return [ x['PutRequest']['Item'] for x in unprocessed ]
+
+
+def batch_delete_items(ddb, tablename, keys, max_attempts=5, backoff=0.05):
+  # Deletes the items with the given key dicts and returns the keys that
+  # stayed unprocessed
+  unprocessed = _batch_write(
+    ddb, 
+    tablename, 
+    [ { 'DeleteRequest': { 'Key': key } } for key in keys ],
+    max_attempts,
+    backoff
+  )
+  return [ x['DeleteRequest']['Key'] for x in unprocessed ]
@@ -0,0 +1,144 @@
+import os
+import threading
+
+from . import startup
+
+# boto3 clients and resources are created once per container and shared by
+# every entry point, so credential resolution, endpoint setup and TLS
+# connections are reused across invocations. Timeouts and attempts are
+# chosen so that all attempts of a stuck call, (connect + read) * attempts
+# = 6 s by default, fail within the 10 second Lambda timeout and leave the
+# invocation time to report the error; keep that in mind when changing
+# them or the function Timeout.
+#
+# SES sends are not retried by botocore: a send that timed out may still
+# have been delivered, and retrying it would deliver the mail twice. One
+# attempt gets a longer read timeout instead, 7 s with the connect timeout,
+# and a failed send is retried thru the send claim and queue redelivery of
+# the handler.
+#
+# boto3, botocore and anawsutils take hundreds of milliseconds to import,
+# so they are only imported when the first client is created; modules keep
+# Lazy stand-ins at module level instead of creating clients at import.
+
+def _get_env(key, default):
+  return os.environ[key] if key in os.environ else default
+
+
+_boto_config = None
+_ses_config  = None
+_clients     = {}
+_resources   = {}
+_lock        = threading.Lock()
+
+
+def get_boto_config():
+  global _boto_config
+  if _boto_config is None:
+    with startup.timed('botocore'):
+      from botocore.config import Config as BotoConfig
+
+    _boto_config = BotoConfig(
+      connect_timeout      = float(_get_env('aws_connect_timeout', '1')),
+      read_timeout         = float(_get_env('aws_read_timeout', '2')),
+      max_pool_connections = int(_get_env('aws_max_pool_connections', '25')),
+      tcp_keepalive        = True,
+      retries = {
+        'mode':               'adaptive',
+        'total_max_attempts': int(_get_env('aws_max_attempts', '2'))
+      }
+    )
+  return _boto_config
+
+
+def get_ses_config():
+  global _ses_config
+  if _ses_config is None:
+    from botocore.config import Config as BotoConfig
+
+    _ses_config = get_boto_config().merge(BotoConfig(
+      read_timeout = float(_get_env('aws_ses_read_timeout', '6')),
+      retries = {
+        'mode':               'standard',
+        'total_max_attempts': 1
+      }
+    ))
+  return _ses_config
+
+
+_boto3_module = None
+
+
+def _boto3():
+  global _boto3_module
+  if _boto3_module is None:
+    with startup.timed('boto3'):
+      import boto3
+    _boto3_module = boto3
+  return _boto3_module
+
+
+def get_client(service_name):
+  if service_name not in _clients:
+    with _lock:
+      if service_name not in _clients:
+        boto3 = _boto3()
+        with startup.timed('{} client'.format(service_name)):
+          config = get_ses_config() if service_name == 'ses' else get_boto_config()
+          _clients[service_name] = boto3.client(service_name, config=config)
+  return _clients[service_name]
+
+
+def get_resource(service_name):
+  if service_name not in _resources:
+    with _lock:
+      if service_name not in _resources:
+        boto3 = _boto3()
+        with startup.timed('{} resource'.format(service_name)):
+          _resources[service_name] = boto3.resource(service_name, config=get_boto_config())
+  return _resources[service_name]
+
+
+class Lazy(object):
+  # Stands in for the object returned by factory, which is called on the
+  # first attribute access and should cache its result
+  def __init__(self, factory):
+    self._factory = factory
+
+  def __getattr__(self, name):
+    return getattr(self._factory(), name)
+
+
+_ddb = None
+_sns = None
+
+
+def get_ddb():
+  global _ddb
+  if _ddb is None:
+    resource = get_resource('dynamodb')
+    with startup.timed('anawsutils.dynamodb'):
+      from anawsutils import dynamodb
+
+    class DDB(dynamodb.DDB):
+      def __init__(self):
+        self.dynamodb = resource
+        self.tables = {}
+
+    _ddb = DDB()
+  return _ddb
+
+
+def get_sns():
+  global _sns
+  if _sns is None:
+    client = get_client('sns')
+    with startup.timed('anawsutils.sns'):
+      from anawsutils import sns
+
+    class SNS(sns.SNS):
+      def __init__(self):
+        self.client = client
+
+    _sns = SNS()
+  return _sns
@@ -0,0 +1,121 @@
+import threading
+import time
+
+from datetime import datetime
+
+
+TRUNCATED = '\n... (truncated)'
+
+
+def _truncate(s, size):
+  b = s.encode()
+  if len(b) <= size:
+    return s
+  return b[:max(size - len(TRUNCATED), 0)].decode(errors='ignore') + TRUNCATED
+
+
+class ErrorAggregator(object):
+  # Collects exceptions and sends them to admins as digests instead of one
+  # message per exception. Exceptions are grouped by fingerprint (exception
+  # type and what was being done) and each fingerprint is reported at most
+  # once per interval seconds; repeats in between are only counted and
+  # reported with the next digest. Only the first occurrence of each
+  # reported group is included in full, up to max_sample_size bytes, and a
+  # digest is capped at max_size bytes.
+  #
+  # With an executor the digests are published in the background as soon
+  # as something is due; flush() waits for that and publishes whatever is
+  # still due.
+  def __init__(self, publish, interval=300, max_size=65536, max_sample_size=4096, executor=None):
+    self.publish         = publish
+    self.interval        = interval
+    self.max_size        = max_size
+    self.max_sample_size = max_sample_size
+    self.executor        = executor
+    self.logger          = None
+    self._errors         = {}
+    self._future         = None
+    self._lock           = threading.Lock()
+
+
+  def add(self, logger, e, when, text):
+    fingerprint = (type(e).__name__, when)
+    now = time.monotonic()
+
+    with self._lock:
+      self.logger = logger
+      entry = self._errors.get(fingerprint)
+      if entry is None:
+        entry = self._errors[fingerprint] = { 'count': 0, 'sample': None, 'first': None, 'sent': None }
+
+      entry['count'] += 1
+      if entry['sample'] is None:
+        entry['sample'] = _truncate(text, self.max_sample_size)
+        entry['first'] = datetime.now().isoformat()
+
+      if self.executor is not None and self._is_due(entry, now):
+        if self._future is None or self._future.done():
+          self._future = self.executor.submit(self._drain)
+
+
+  def _is_due(self, entry, now):
+    return entry['count'] > 0 and (entry['sent'] is None or now - entry['sent'] >= self.interval)
+
+
+  def _take_digest(self):
+    with self._lock:
+      now = time.monotonic()
+      parts = []
+      size = 0
+      total = 0
+      for (name, when), entry in self._errors.items():
+        if not self._is_due(entry, now):
+          continue
+
+        part = '{} x {}{}, first at {}:\n{}\n{}\n'.format(
+          entry['count'],
+          name,
+          (" while " + when) if when is not None else "",
+          entry['first'],
+          '-'*60,
+          entry['sample']
+        )
+        if len(parts) > 0 and size + len(part.encode()) > self.max_size:
+          # Left for the next digest
+          break
+
+        parts.append(part)
+        size += len(part.encode())
+        total += entry['count']
+        entry.update({ 'count': 0, 'sample': None, 'first': None, 'sent': now })
+
+    if len(parts) == 0:
+      return None
+
+    if total == 1:
+      subject = "Virtualmail exception"
+    else:
+      subject = "Virtualmail exceptions ({} in {} groups)".format(total, len(parts))
+
+    return subject, _truncate(('\n' + '='*60 + '\n\n').join(parts), self.max_size)
+
+
+  def _drain(self):
+    while True:
+      digest = self._take_digest()
+      if digest is None:
+        return
+
+      try:
+        self.publish(self.logger, *digest)
+      except Exception as _e:
+        self.logger.error("Exception while sending admin message: "+str(_e))
+
+
+  def flush(self):
+    with self._lock:
+      future = self._future
+    if future is not None:
+      future.result()
+
+    self._drain()
@@ -0,0 +1,65 @@
+import threading
+import time
+
+from .batch import BATCH_WRITE_MAX_ITEMS, batch_write_items
+
+
+class LogWriter(object):
+  # Buffers log items for the duration of an invocation. With an executor
+  # the buffer is drained in the background as soon as items arrive, so the
+  # writes overlap with the S3 fetches and sends; items that arrive while a
+  # write is in flight are grouped into the next batch. flush() waits for
+  # the background writes and writes whatever is left.
+  def __init__(self, ddb, tablename, ttl_days=0, executor=None):
+    self.ddb       = ddb
+    self.tablename = tablename
+    self.ttl_days  = ttl_days
+    self.executor  = executor
+    self.errors    = []
+    self._buffer   = []
+    self._future   = None
+    self._lock     = threading.Lock()
+
+
+  def add(self, item):
+    if self.ttl_days > 0:
+      item['ttl'] = int(time.time()) + self.ttl_days * 86400
+
+    with self._lock:
+      self._buffer.append(item)
+      if self.executor is not None and (self._future is None or self._future.done()):
+        self._future = self.executor.submit(self._drain)
+
+
+  def _take(self):
+    with self._lock:
+      items = self._buffer[:BATCH_WRITE_MAX_ITEMS]
+      del self._buffer[:BATCH_WRITE_MAX_ITEMS]
+      return items
+
+
+  def _drain(self):
+    while True:
+      items = self._take()
+      if len(items) == 0:
+        return
+
+      try:
+        unprocessed = batch_write_items(self.ddb, self.tablename, items)
+        if len(unprocessed) > 0:
+          raise Exception("{} items left unprocessed".format(len(unprocessed)))
+      except Exception as e:
+        self.errors.append((e, items))
+
+
+  def flush(self):
+    # Returns a list of (exception, items) for the writes that failed
+    with self._lock:
+      future = self._future
+    if future is not None:
+      future.result()
+
+    self._drain()
+
+    errors, self.errors = self.errors, []
+    return errors
@@ -0,0 +1,91 @@
+import re
+
+from functools import lru_cache
+
+MEMO_SIZE = 4096
+
+# Patterns made only of these characters (optionally anchored with '$') are
+# treated as plain text; an unescaped '.' is taken literally as in domains
+_literal = re.compile(r'^(?:[A-Za-z0-9@_-]|\\?\.)+\$?$')
+
+
+def _unescape(pattern):
+  return pattern.rstrip('$').replace('\\.', '.')
+
+
+class DomainMatcher(object):
+  # Compiled replacement for checking an address against a list of domains
+  # with re.search('@{}$'.format(domain), address, re.IGNORECASE). Plain
+  # domains are answered with a set lookup and only real regex entries are
+  # combined into a single alternation.
+  def __init__(self, domains):
+    exact = set()
+    patterns = []
+    for domain in domains:
+      if _literal.match(domain) and '@' not in domain:
+        exact.add(_unescape(domain).lower())
+      else:
+        patterns.append('(?:{})'.format(domain))
+
+    self.domains = frozenset(exact)
+    self._regex = None
+    if len(patterns) > 0:
+      self._regex = re.compile('@(?:{})$'.format('|'.join(patterns)), re.IGNORECASE)
+
+    self.match = lru_cache(maxsize=MEMO_SIZE)(self._match)
+
+
+  def __len__(self):
+    return len(self.domains) + (0 if self._regex is None else 1)
+
+
+  def _match(self, address):
+    x = address.split('@')
+    if len(x) > 1 and x[-1].lower() in self.domains:
+      return True
+    return self._regex is not None and self._regex.search(address) is not None
+
+
+class AddressFilter(object):
+  # Compiled replacement for matching an address against a list of regexes
+  # with re.search(pattern, address). Literal patterns anchored to the end
+  # of the address (like '@test.example.com$') become one str.endswith()
+  # call, other literals a substring check, and the remaining regexes are
+  # combined into a single alternation.
+  def __init__(self, patterns):
+    suffixes = []
+    substrings = []
+    regexes = []
+    for pattern in patterns:
+      if _literal.match(pattern):
+        if pattern.endswith('$'):
+          suffixes.append(_unescape(pattern))
+        else:
+          substrings.append(_unescape(pattern))
+      else:
+        regexes.append('(?:{})'.format(pattern))
+
+    self.suffixes = tuple(suffixes)
+    self.substrings = tuple(substrings)
+    self._regex = re.compile('|'.join(regexes)) if len(regexes) > 0 else None
+
+    self.match = lru_cache(maxsize=MEMO_SIZE)(self._match)
+
+
+  def _match(self, address):
+    if len(self.suffixes) > 0 and address.endswith(self.suffixes):
+      return True
+    for x in self.substrings:
+      if x in address:
+        return True
+    return self._regex is not None and self._regex.search(address) is not None
+
+
+@lru_cache(maxsize=None)
+def _get_domain_matcher(domains):
+  return DomainMatcher(domains)
+
+
+def get_domain_matcher(domains):
+  # Matchers are built once per container for each distinct domain list
+  return _get_domain_matcher(tuple(domains))
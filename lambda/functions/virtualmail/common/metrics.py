@@ -0,0 +1,102 @@
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+
+# Per unit of work metrics (a record in the handler, an SES rule call in the
+# gatekeeper, a request in the API) written to stdout as one CloudWatch
+# Embedded Metric Format line, which CloudWatch turns into metrics without
+# any API calls. Stage durations are in milliseconds and add up if a stage
+# runs more than once, e.g. one SES send per vmail. Properties are only
+# logged, so they can be searched with Logs Insights but do not become
+# metrics.
+#
+# Setting metrics_namespace to an empty string turns the output off.
+
+def _get_env(key, default):
+  return os.environ[key] if key in os.environ else default
+
+
+namespace = _get_env('metrics_namespace', 'Virtualmail')
+
+MILLISECONDS = 'Milliseconds'
+BYTES        = 'Bytes'
+COUNT        = 'Count'
+
+_write_lock = threading.Lock()
+
+
+def _write(line):
+  with _write_lock:
+    sys.stdout.write(line + '\n')
+    sys.stdout.flush()
+
+
+class Metrics(object):
+  def __init__(self, function, dimensions=None):
+    self.dimensions = { 'Function': function, **(dimensions or {}) }
+    self.properties = {}
+    self._values    = {}
+    self._units     = {}
+    self._lock      = threading.Lock()
+
+
+  def add(self, name, value, unit=COUNT):
+    with self._lock:
+      self._values[name] = self._values.get(name, 0) + value
+      self._units[name] = unit
+
+
+  @contextmanager
+  def timer(self, name):
+    t = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.add(name, (time.perf_counter() - t) * 1000, MILLISECONDS)
+
+
+  def update(self, other):
+    # Adds the values of another Metrics, e.g. batch level stages
+    with other._lock:
+      items = [ (k, v, other._units[k]) for k, v in other._values.items() ]
+    for k, v, unit in items:
+      self.add(k, v, unit)
+
+
+  def set_property(self, name, value):
+    self.properties[name] = value
+
+
+  def emit(self):
+    if len(namespace) == 0:
+      return
+
+    with self._lock:
+      values = { k: round(v, 3) for k, v in self._values.items() }
+      units = { **self._units }
+
+    line = {
+      '_aws': {
+        'Timestamp': int(time.time() * 1000),
+        'CloudWatchMetrics': [ {
+          'Namespace':  namespace,
+          'Dimensions': [ list(self.dimensions.keys()) ],
+          'Metrics':    [ { 'Name': k, 'Unit': units[k] } for k in values.keys() ]
+        } ]
+      },
+      **self.properties,
+      **self.dimensions,
+      **values
+    }
+    _write(json.dumps(line, default=str))
+
+
+def should_dump(rate):
+  # Full event dumps are for debugging; rate is the sampled fraction of
+  # invocations, 0 turns them off and 1 dumps every event
+  return rate > 0 and (rate >= 1 or random.random() < rate)
@@ -0,0 +1,115 @@
+from collections import namedtuple
+from types import MappingProxyType
+
+
+# Values resolved for one of our email domains from the per-domain config
+# dicts, where '%' is the fallback for domains without an entry of their own
+DomainRoute = namedtuple('DomainRoute', [
+  'domain',
+  'master_email',
+  'bounces_email',
+  'default_sender'
+])
+
+
+def _check_domain_values(name, d, required=False, nullable=False):
+  if not isinstance(d, dict):
+    raise ValueError("{} must be a JSON object, not {}".format(name, type(d).__name__))
+
+  if required is True and '%' not in d:
+    raise ValueError("{} is missing the '%' (default) key".format(name))
+
+  for k, v in d.items():
+    if not isinstance(k, str) or len(k) == 0:
+      raise ValueError("{} has an invalid domain key {!r}".format(name, k))
+    if v is None and nullable is True:
+      continue
+    if not isinstance(v, str) or '@' not in v:
+      raise ValueError("{} has an invalid address {!r} for {}".format(name, v, k))
+
+  return { k.lower(): v for k, v in d.items() }
+
+
+def _resolve(d, domain):
+  return d[domain] if domain in d else d.get('%')
+
+
+class Routing(object):
+  # Immutable routing table built once per container from the handler
+  # config. Domain membership is a set lookup and the per-domain values are
+  # resolved in advance, so nothing is parsed or probed per message. Domains
+  # are matched case insensitively. Invalid config raises ValueError.
+  def __init__(self, email_domains, master_email, bounces_email, default_sender, print_mail_info=True):
+    if not isinstance(email_domains, list) or len(email_domains) == 0:
+      raise ValueError("email_domains must be a non-empty JSON list")
+    for x in email_domains:
+      if not isinstance(x, str) or len(x) == 0 or '@' in x:
+        raise ValueError("email_domains has an invalid domain {!r}".format(x))
+
+    master_email   = _check_domain_values('master_email', master_email, nullable=True)
+    bounces_email  = _check_domain_values('bounces_email', bounces_email, required=True)
+    default_sender = _check_domain_values('default_sender', default_sender, required=True)
+
+    self.domains = frozenset([ x.lower() for x in email_domains ])
+    self.routes = MappingProxyType({
+      x: DomainRoute(
+        x,
+        _resolve(master_email, x),
+        _resolve(bounces_email, x),
+        _resolve(default_sender, x)
+      )
+      for x in self.domains
+    })
+    self.print_mail_info = print_mail_info is True
+
+    # Per-domain entries for domains we do not handle are never used
+    self.unknown = sorted(
+      (set(master_email) | set(bounces_email) | set(default_sender)) - self.domains - set(['%'])
+    )
+
+
+  @classmethod
+  def from_config(cls, config):
+    return cls(
+      config.get_value('email_domains'),
+      config.get_value('master_email'),
+      config.get_value('bounces_email'),
+      config.get_value('default_sender'),
+      config.get_value('print_mail_info')
+    )
+
+
+  def get(self, address):
+    # Returns the DomainRoute for an address in one of our domains, else None
+    x = address.split('@')
+    if len(x) != 2:
+      return None
+    return self.routes.get(x[1].lower())
+
+
+  def is_ours(self, address):
+    return self.get(address) is not None
+
+
+# Set on every forwarded message to the number of times virtualmail has
+# forwarded it, so that a message that comes back (e.g. thru an external
+# auto-forward) is recognized
+HOPS_HEADER = 'X-Virtualmail-Hops'
+
+
+def get_hops(headers):
+  # headers is either the list of { name, value } dicts of an SES
+  # notification or the header dict of an injected message
+  if isinstance(headers, dict):
+    headers = [ { 'name': k, 'value': v } for k, v in headers.items() ]
+  if not isinstance(headers, list):
+    return 0
+
+  hops = 0
+  for x in headers:
+    if isinstance(x, dict) and str(x.get('name')).lower() == HOPS_HEADER.lower():
+      try:
+        hops = max(hops, int(x.get('value')))
+      except (TypeError, ValueError):
+        hops = max(hops, 1)
+  return hops
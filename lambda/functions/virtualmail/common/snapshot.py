@@ -0,0 +1,249 @@
+import hashlib
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+# Snapshot file layout (all integers little endian):
+#
+#   header   MAGIC, created (epoch float), key count, bloom bits,
+#            bloom hash count, bloom length in bytes
+#   bloom    bloom filter bit array
+#   offsets  key count + 1 uint32 offsets into the key blob
+#   keys     sorted utf-8 encoded keys, concatenated
+#
+# The file is used directly thru mmap, so only the pages that are actually
+# touched by a lookup are read into memory.
+
+MAGIC  = b'VMSNAP01'
+HEADER = struct.Struct('<8sdIIII')
+OFFSET = struct.Struct('<I')
+
+BLOOM_FALSE_POSITIVE_RATE = 0.01
+
+
+def _hashes(key):
+  d = hashlib.blake2b(key.encode(), digest_size=16).digest()
+  return int.from_bytes(d[:8], 'little'), int.from_bytes(d[8:], 'little') | 1
+
+
+class BloomFilter(object):
+  def __init__(self, bits, hashes, data=None):
+    self.bits   = bits
+    self.hashes = hashes
+    self.data   = bytearray((bits + 7) // 8) if data is None else data
+
+
+  @classmethod
+  def for_capacity(cls, count, fp_rate=BLOOM_FALSE_POSITIVE_RATE):
+    n = max(count, 1)
+    bits = max(64, int(math.ceil(-n * math.log(fp_rate) / (math.log(2) ** 2))))
+    hashes = max(1, int(round(bits / n * math.log(2))))
+    return cls(bits, hashes)
+
+
+  def _positions(self, key):
+    h1, h2 = _hashes(key)
+    for i in range(self.hashes):
+      yield (h1 + i * h2) % self.bits
+
+
+  def add(self, key):
+    for pos in self._positions(key):
+      self.data[pos >> 3] |= 1 << (pos & 7)
+
+
+  def __contains__(self, key):
+    for pos in self._positions(key):
+      if not self.data[pos >> 3] & (1 << (pos & 7)):
+        return False
+    return True
+
+
+def build_snapshot(keys, created=None):
+  _keys = sorted(set([ x.lower() for x in keys ]))
+  _created = time.time() if created is None else created
+
+  bloom = BloomFilter.for_capacity(len(_keys))
+  blob = bytearray()
+  offsets = bytearray()
+  for key in _keys:
+    bloom.add(key)
+    offsets += OFFSET.pack(len(blob))
+    blob += key.encode()
+  offsets += OFFSET.pack(len(blob))
+
+  header = HEADER.pack(
+    MAGIC,
+    _created,
+    len(_keys),
+    bloom.bits,
+    bloom.hashes,
+    len(bloom.data)
+  )
+  return bytes(header + bloom.data + offsets + blob)
+
+
+class AddressSnapshot(object):
+  def __init__(self, buf, path=None):
+    magic, created, count, bits, hashes, bloom_len = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC:
+      raise ValueError("Not an address snapshot")
+
+    self.buf     = buf
+    self.path    = path
+    self.created = created
+    self.count   = count
+
+    view = memoryview(buf)
+    self.bloom   = BloomFilter(bits, hashes, view[HEADER.size:HEADER.size + bloom_len])
+    self._offsets = HEADER.size + bloom_len
+    self._keys    = self._offsets + (count + 1) * OFFSET.size
+
+
+  @classmethod
+  def from_file(cls, path):
+    with open(path, 'rb') as f:
+      buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return cls(buf, path)
+
+
+  def _key_at(self, i):
+    start, = OFFSET.unpack_from(self.buf, self._offsets + i * OFFSET.size)
+    end,   = OFFSET.unpack_from(self.buf, self._offsets + (i + 1) * OFFSET.size)
+    return self.buf[self._keys + start:self._keys + end]
+
+
+  def __contains__(self, address):
+    key = address.lower()
+    if key not in self.bloom:
+      return False
+
+    # Rule out bloom filter false positives from the sorted key array
+    k = key.encode()
+    lo, hi = 0, self.count
+    while lo < hi:
+      mid = (lo + hi) // 2
+      x = self._key_at(mid)
+      if x < k:
+        lo = mid + 1
+      elif x > k:
+        hi = mid
+      else:
+        return True
+    return False
+
+
+  def close(self):
+    # Release the bloom filter view first, mmap refuses to close otherwise
+    self.bloom.data.release()
+    if isinstance(self.buf, mmap.mmap):
+      self.buf.close()
+
+
+class SnapshotLoader(object):
+  # Loads an address snapshot from a local path or from s3://bucket/key and
+  # keeps it fresh by rechecking the S3 object's ETag every refresh_interval
+  # seconds. S3 is only read in a background thread, get() never waits for
+  # it and returns None until the first snapshot has been loaded. Snapshots
+  # older than max_age seconds (0 disables the check) are not returned, so
+  # that a builder that has stopped running does not hide new addresses.
+  # A missing S3 object means that no snapshot has been built yet.
+  def __init__(self, source, refresh_interval=60, s3_client=None, max_age=0, on_error=None):
+    self.source = source
+    self.refresh_interval = refresh_interval
+    self.s3_client = s3_client
+    self.max_age = max_age
+    self.on_error = on_error
+    self._snapshot = None
+    self._retired = None
+    self._etag = None
+    self._next_check = 0
+    self._refreshing = False
+    self._lock = threading.Lock()
+
+
+  @staticmethod
+  def get_bucket_and_key(url):
+    a = url.split('/')
+    return a[2], '/'.join(a[3:])
+
+
+  def get(self):
+    if not self.source.startswith('s3://'):
+      if self._snapshot is None:
+        self._snapshot = AddressSnapshot.from_file(self.source)
+    else:
+      with self._lock:
+        start = self._refreshing is False and time.monotonic() >= self._next_check
+        if start:
+          self._next_check = time.monotonic() + self.refresh_interval
+          self._refreshing = True
+      if start:
+        threading.Thread(target=self._refresh_in_background, daemon=True).start()
+
+    snapshot = self._snapshot
+    if snapshot is None:
+      return None
+    if self.max_age > 0 and time.time() - snapshot.created > self.max_age:
+      return None
+    return snapshot
+
+
+  def _refresh_in_background(self):
+    try:
+      self._refresh()
+    except Exception as e:
+      if self.on_error is not None:
+        self.on_error(e)
+    finally:
+      with self._lock:
+        self._refreshing = False
+
+
+  def _refresh(self):
+    if self.s3_client is None:
+      import boto3
+      self.s3_client = boto3.client('s3')
+
+    from botocore.exceptions import ClientError
+
+    bucket, key = self.get_bucket_and_key(self.source)
+    params = {} if self._etag is None else { 'IfNoneMatch': self._etag }
+
+    try:
+      obj = self.s3_client.get_object(Bucket=bucket, Key=key, **params)
+    except ClientError as e:
+      status = e.response['ResponseMetadata']['HTTPStatusCode']
+      if status == 304:
+        # Not modified
+        return
+      if status == 404:
+        # Not built yet, or removed
+        self._replace(None, None)
+        return
+      raise
+
+    fd, path = tempfile.mkstemp(prefix='addresses-', suffix='.snap')
+    with os.fdopen(fd, 'wb') as f:
+      for chunk in obj['Body'].iter_chunks():
+        f.write(chunk)
+
+    self._replace(AddressSnapshot.from_file(path), obj['ETag'])
+
+
+  def _replace(self, snapshot, etag):
+    # A lookup in another thread may still be using the current snapshot,
+    # so it is only closed when it is replaced the next time
+    if snapshot is None and self._snapshot is None:
+      return
+
+    retired, self._retired = self._retired, self._snapshot
+    self._snapshot, self._etag = snapshot, etag
+
+    if retired is not None:
+      retired.close()
+      os.remove(retired.path)
@@ -0,0 +1,59 @@
+import threading
+import time
+
+from contextlib import contextmanager
+
+# Cold start profile. Entry points mark the end of each init step with
+# mark() and heavy dependencies that are loaded on first use are wrapped in
+# timed(); report() logs what was recorded since the previous report, the
+# first time together with the total time from the first import of this
+# module, so that import time regressions show up in the function logs.
+
+_started  = time.perf_counter()
+_last     = _started
+_timings  = []
+_reported = False
+_lock     = threading.Lock()
+
+
+def mark(name):
+  # Records the time since the previous mark as the cost of step name
+  global _last
+  now = time.perf_counter()
+  with _lock:
+    _timings.append((name, now - _last))
+    _last = now
+
+
+@contextmanager
+def timed(name):
+  t = time.perf_counter()
+  try:
+    yield
+  finally:
+    with _lock:
+      _timings.append((name, time.perf_counter() - t))
+
+
+def _format(timings):
+  return ', '.join([ '{} {:.1f} ms'.format(name, t * 1000) for name, t in timings ]) or '-'
+
+
+def report(logger):
+  global _reported
+  with _lock:
+    if _reported is True and len(_timings) == 0:
+      return
+    timings = _timings[:]
+    del _timings[:]
+    first = not _reported
+    _reported = True
+
+  if first is True:
+    logger.info("Init took {:.1f} ms: {}".format(
+      (time.perf_counter() - _started) * 1000,
+      _format(timings)
+    ))
+  else:
+    # Dependencies that were loaded on first use during earlier invocations
+    logger.info("Deferred init: {}".format(_format(timings)))
@@ -1,7 +1,11 @@
 import os
-from anawsutils.sns import SNS
 
-sns = SNS()
+from concurrent.futures import ThreadPoolExecutor
+
+from . import clients
+from .errors import ErrorAggregator
+
+sns = clients.Lazy(clients.get_sns)
 sns_arn =  os.environ["sns_admin"] if "sns_admin" in os.environ else None
 
 
@@ -14,6 +18,28 @@ def send_admin_sns(logger, subject, message):
     return response
 
 
+def _get_env(key, default):
+  return os.environ[key] if key in os.environ else default
+
+
+# Admin messages are published as rate limited digests on a background 
+# thread; the aggregator lives across warm invocations so that a burst of 
+# identical errors is reported once per error_digest_interval seconds
+errors = ErrorAggregator(
+  send_admin_sns,
+  interval=int(_get_env('error_digest_interval', '300')),
+  max_size=int(_get_env('error_digest_max_size', '65536')),
+  max_sample_size=int(_get_env('error_digest_max_sample_size', '4096')),
+  executor=ThreadPoolExecutor(max_workers=1)
+)
+
+
+def flush_errors():
+  # Called at the end of each invocation, Lambda freezes the background
+  # thread as soon as the handler returns
+  errors.flush()
+
+
 def handle_exception(logger, e, when=None, text=None, stop_processing=False):
   import traceback
   s = 'Exception "{}"{}:\n{}\n{}'.format(
@@ -27,11 +53,9 @@ def handle_exception(logger, e, when=None, text=None, stop_processing=False):
 
   logger.error(s)
 
-  try:
-    send_admin_sns(logger, "Virtualmail exception", s)
-  except Exception as e:
-    logger.error("Exception while sending admin message: "+str(e))
+  errors.add(logger, e, when, s)
 
   if stop_processing == True:
+    flush_errors()
     raise e
   
\ No newline at end of file
@@ -0,0 +1,45 @@
+from . import clients, startup
+
+# Warm-up invocations, e.g. from a scheduled rule, have an event like
+#
+#   { "warmup": true, "services": [ "dynamodb", "s3" ] }
+#
+# The clients of the given services (or the entry point's own services) are
+# created and one cheap call is made on each so that imports, endpoint
+# setup, credentials and the TLS connection are ready for the next real
+# invocation. The calls may well be denied by IAM; that does not matter as
+# the connection is opened and pooled all the same.
+
+WARMUP_CALLS = {
+  'dynamodb': lambda: clients.get_ddb().dynamodb.meta.client.describe_endpoints(),
+  's3':       lambda: clients.get_client('s3').list_buckets(),
+  'ses':      lambda: clients.get_client('ses').get_send_quota(),
+  'sns':      lambda: clients.get_sns().client.list_topics()
+}
+
+
+def is_warmup(event):
+  return isinstance(event, dict) and event.get('warmup') is True
+
+
+def warm_up(logger, event, services):
+  services = event.get('services', services)
+
+  warmed = []
+  for service in services:
+    if service not in WARMUP_CALLS:
+      logger.warning("Unknown service {} in warm-up event".format(service))
+      continue
+
+    try:
+      with startup.timed('{} warm-up'.format(service)):
+        WARMUP_CALLS[service]()
+    except Exception as e:
+      if not hasattr(e, 'response'):
+        # Not an error response from the service, so no connection either
+        logger.warning("Warming up {} failed: {}".format(service, e))
+        continue
+    warmed.append(service)
+
+  startup.report(logger)
+  return { 'warmup': warmed }
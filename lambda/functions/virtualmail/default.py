@@ -1,12 +1,22 @@
 import json
+from .common import startup
+from .common.warmup import is_warmup, warm_up
 from anlogger import Logger
 logger_obj = Logger(name="virtualmail", default_loglevel="INFO", fmt=None, syslog=None)
 logger = logger_obj.get()
+startup.mark('anlogger')
 
 def lambda_handler(event, context):
+  if is_warmup(event):
+    # { "warmup": true, "services": [...] } pre-opens the connections of
+    # the given services, see common/warmup.py
+    return warm_up(logger, event, [ 'dynamodb', 's3', 'ses', 'sns' ])
+
+  startup.report(logger)
   logger.warn("Default handler in virtualmail app container called - please configure Lambda to call the correct handler!")
   logger.info(json.dumps(event))
 
 
 # docker run --rm -p 9001:8080 -e AWS_ACCESS_KEY_ID=redacted -e AWS_SECRET_ACCESS_KEY=redacted -e AWS_REGION=eu-central-1  virtualmail:latest virtualmail.default.lambda_handler
 # curl -XPOST "http://localhost:9001/2015-03-31/functions/function/invocations" -d "@sample.txt"
+# curl -XPOST "http://localhost:9001/2015-03-31/functions/function/invocations" -d '{ "warmup": true }'
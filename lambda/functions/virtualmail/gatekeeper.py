@@ -1,28 +1,134 @@
-import re
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 
+from .common import startup
 from .common import utils
+from .common.addresses import AddressBook, AddressCache
+from .common.matchers import get_domain_matcher
+from .common.metrics import Metrics
+from .common.routing import get_hops
+from .common.snapshot import SnapshotLoader
+from .common.warmup import is_warmup, warm_up
+startup.mark('virtualmail.common')
 
 from anlogger import Logger
 _logger = Logger("virtualemail-gatekeeper", 'INFO')
 logger = _logger.get()
+startup.mark('anlogger')
 
-from anawsutils import dynamodb
-ddb = dynamodb.DDB()
+from .common import clients
+ddb = clients.Lazy(clients.get_ddb)
 
 from anenvconf import Config, ConfigValueType
 config_schema = {
   'email_domains': {
     'type': ConfigValueType.JSON      
   },
-  'ddb_tablename': {}
+  'ddb_tablename': {},
+  'address_cache_size': {
+    'type': ConfigValueType.INT,
+    'default': '1024'
+  },
+  'address_cache_ttl': {
+    'type': ConfigValueType.INT,
+    'default': '60'
+  },
+  # Nonexistent addresses are not cached by default: the first mail to a
+  # just created address, often an account verification, must not be dropped
+  'address_cache_negative_ttl': {
+    'type': ConfigValueType.INT,
+    'default': '0'
+  },
+  'address_snapshot': {
+    'default': ''
+  },
+  'address_snapshot_refresh': {
+    'type': ConfigValueType.INT,
+    'default': '60'
+  },
+  'address_snapshot_max_age': {
+    'type': ConfigValueType.INT,
+    'default': '3600'
+  },
+  'time_budget_ms': {
+    'type': ConfigValueType.INT,
+    'default': '3000'
+  },
+  'max_hops': {
+    'type': ConfigValueType.INT,
+    'default': '1'
+  }
 }
 
 config = Config(config_schema)
-email_domains = config.get_value('email_domains')
+email_domains = get_domain_matcher(config.get_value('email_domains'))
 ddb_tablename = config.get_value('ddb_tablename')
+startup.mark('config')
 
+address_cache = AddressCache(
+  config.get_value('address_cache_size'),
+  config.get_value('address_cache_ttl'),
+  config.get_value('address_cache_negative_ttl')
+)
+
+if len(config.get_value('address_snapshot')) > 0:
+  # The snapshot is loaded and refreshed in the background; until there is
+  # a current one every lookup goes to DynamoDB
+  snapshot_loader = SnapshotLoader(
+    config.get_value('address_snapshot'),
+    config.get_value('address_snapshot_refresh'),
+    s3_client=clients.Lazy(lambda: clients.get_client('s3')),
+    max_age=config.get_value('address_snapshot_max_age'),
+    on_error=lambda e: utils.handle_exception(logger, e, 'loading address snapshot')
+  )
+else:
+  snapshot_loader = None
+
+
+# Lookups run in a worker thread so that the SES rule can be answered within
+# the time budget even if DynamoDB is slow
+executor = ThreadPoolExecutor(max_workers=2)
+startup.mark('gatekeeper setup')
+
+
+def get_address_snapshot():
+  if snapshot_loader is None:
+    return None
+
+  try:
+    return snapshot_loader.get()
+  except Exception as e:
+    # Without a snapshot every lookup simply goes to DynamoDB
+    utils.handle_exception(logger, e, 'loading address snapshot')
+    return None
+
+
+def lookup_recipients(recipients):
+  # Returns True if any of the recipients exists, False if none of them
+  # exists and None if that could not be determined
+  book = AddressBook(ddb, ddb_tablename, cache=address_cache)
+  found = book.prefetch(recipients)
+
+  if any([ x is not None for x in found.values() ]):
+    return True
+
+  if len(found) < len(set([ x.lower() for x in recipients ])):
+    return None
+
+  return False
+
+
+def get_time_budget(context):
+  budget = config.get_value('time_budget_ms') / 1000
+  if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+    # Leave a moment for logging and returning the answer
+    remaining = context.get_remaining_time_in_millis() / 1000 - 0.5
+    budget = min(budget, max(remaining, 0))
+  return budget
+
+
+def check_message(event, context, metrics):
+  _to = _from = _subj = '<unknown>'
 
-def lambda_handler(event, context):
   try:
     msg = event['Records'][0]['ses']
     _recipients = msg['mail']['destination']
@@ -42,20 +148,42 @@ def lambda_handler(event, context):
     except:
       _subj = '<unknown>'
   
-    recipients = []
-    for recipient in _recipients:
-      for email_domain in email_domains:
-        if re.search('@{}$'.format(email_domain), recipient, re.IGNORECASE):
-          recipients.append(recipient)
+    if get_hops(msg['mail'].get('headers')) >= config.get_value('max_hops'):
+      # Forwarded by us before and came back, stop the loop before the
+      # message is stored and handled again
+      metrics.add('loops', 1)
+      logger.info("Dropping message, mail loop detected (From: {}, To: {}, Subj: {})".format(_from, _to, _subj))
+      return {'disposition': 'stop_rule_set'}
+
+    recipients = [ x for x in _recipients if email_domains.match(x) ]
+    metrics.add('recipients', len(recipients))
       
+    with metrics.timer('snapshot'):
+      snapshot = get_address_snapshot()
+      known = snapshot is not None and any([ x in snapshot for x in recipients ])
+
+    if known:
+      # Accepted without touching DynamoDB. An address missing from the
+      # snapshot may have been created after it was built, so only a
+      # DynamoDB lookup can tell that it does not exist
+      metrics.add('snapshot_hits', 1)
+      logger.info("Accept message (From: {}, To: {}, Subj: {})".format(_from, _to, _subj))
+      return None
+
     if len(recipients) > 0:
-      for recipient in recipients:
-        r = ddb.get_item(ddb_tablename, 'virtualemail', recipient.lower())
-      
-        if r is not None:
-          # Virtual address found, accept email
-          logger.info("Accept message (From: {}, To: {}, Subj: {})".format(_from, _to, _subj))
-          return None
+      future = executor.submit(lookup_recipients, recipients)
+      try:
+        with metrics.timer('ddb_lookup'):
+          exists = future.result(timeout=get_time_budget(context))
+      except TimeoutError:
+        logger.warning("Virtual address lookup exceeded time budget")
+        metrics.add('timeouts', 1)
+        exists = None
+
+      if exists is not False:
+        # Virtual address found or existence unknown, accept email
+        logger.info("Accept message (From: {}, To: {}, Subj: {})".format(_from, _to, _subj))
+        return None
 
     # drop email
     logger.info("Dropping message, virtual address not found (From: {}, To: {}, Subj: {})".format(_from, _to, _subj))
@@ -63,11 +191,33 @@ def lambda_handler(event, context):
       
   except Exception as e:
     # Something failed, we'll notify admins and let the email pass just in case
+    metrics.add('errors', 1)
     try:
       import json
       utils.handle_exception(logger, e, 'lambda_handler()', text=json.dumps(event))
     except Exception as e:
       # Something failed again, let's just let the email pass
-      logger.error("Exception "+e)
+      logger.error("Exception "+str(e))
+
+  # Only the failure path waits for the admin digest, the SES rule is 
+  # answered without it otherwise
+  utils.flush_errors()
     
   logger.info("Accept message (From: {}, To: {}, Subj: {})".format(_from, _to, _subj))
+
+
+def lambda_handler(event, context):
+  startup.report(logger)
+  if is_warmup(event):
+    services = [ 'dynamodb', 'sns' ] if snapshot_loader is None else [ 'dynamodb', 's3', 'sns' ]
+    # Starts loading the snapshot
+    get_address_snapshot()
+    return warm_up(logger, event, services)
+
+  metrics = Metrics('gatekeeper')
+  with metrics.timer('total'):
+    result = check_message(event, context, metrics)
+
+  metrics.add('dropped', 0 if result is None else 1)
+  metrics.emit()
+  return result
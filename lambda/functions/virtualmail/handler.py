@@ -1,18 +1,28 @@
-import boto3
+import base64
 import json
 import re
+import time
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+from .common import startup
 from .common import utils
-from .common.exceptions import PassthroughException
+from .common.addresses import AddressBook, AddressCache
+from .common.logwriter import LogWriter
+from .common.matchers import AddressFilter
+from .common.metrics import BYTES, Metrics, should_dump
+from .common.routing import HOPS_HEADER, Routing, get_hops
+from .common.warmup import is_warmup, warm_up
+startup.mark('virtualmail.common')
 
 from anlogger import Logger
 _logger = Logger("virtualmail-handler", 'INFO')
 logger = _logger.get()
+startup.mark('anlogger')
 
-from anawsutils import dynamodb
-ddb = dynamodb.DDB()
+from .common import clients
+ddb = clients.Lazy(clients.get_ddb)
 
 from anenvconf import Config, ConfigValueType
 config_schema = {
@@ -29,6 +39,17 @@ config_schema = {
     },
     'ddb_tablename': {},
     'ddb_tablename_log': {},
+    'log_ttl_days': {
+        'type': ConfigValueType.INT,
+        'default': '0'
+    },
+    'ddb_tablename_sent': {
+        'default': ''
+    },
+    'sent_ttl_days': {
+        'type': ConfigValueType.INT,
+        'default': '7'
+    },
     'sns_admin': {},
     'master_email': {
         'type': ConfigValueType.JSON,
@@ -41,26 +62,156 @@ config_schema = {
     'print_mail_info': {
         'type': ConfigValueType.BOOL,
         'default': True
+    },
+    'address_cache_size': {
+        'type': ConfigValueType.INT,
+        'default': '1024'
+    },
+    'address_cache_ttl': {
+        'type': ConfigValueType.INT,
+        'default': '60'
+    },
+    # Nonexistent addresses are not cached by default, see gatekeeper
+    'address_cache_negative_ttl': {
+        'type': ConfigValueType.INT,
+        'default': '0'
+    },
+    'handler_concurrency': {
+        'type': ConfigValueType.INT,
+        'default': '1'
+    },
+    'event_dump_rate': {
+        'type': ConfigValueType.JSON,
+        'default': '0'
+    },
+    'max_nesting_depth': {
+        'type': ConfigValueType.INT,
+        'default': '5'
+    },
+    'max_hops': {
+        'type': ConfigValueType.INT,
+        'default': '1'
+    },
+    'ses_max_recipients': {
+        'type': ConfigValueType.INT,
+        'default': '50'
+    },
+    'send_concurrency': {
+        'type': ConfigValueType.INT,
+        'default': '4'
+    },
+    'send_claim_timeout': {
+        'type': ConfigValueType.INT,
+        'default': '20'
     }
 }
 
 config = Config(config_schema)
+startup.mark('config')
+
+address_cache = AddressCache(
+  config.get_value('address_cache_size'),
+  config.get_value('address_cache_ttl'),
+  config.get_value('address_cache_negative_ttl')
+)
+
+email_filter = AddressFilter(config.get_value('email_filter'))
 
+# Domains and their per-domain values are resolved once per container;
+# invalid config fails the container start instead of every message
+try:
+  routing = Routing.from_config(config)
+except Exception as e:
+  utils.handle_exception(logger, e, 'building routing table', stop_processing=True)
 
-def send_raw_email(raw):
-  ses = boto3.client('ses')
-  response = ses.send_raw_email(RawMessage={ 'Data': raw })
+if len(routing.unknown) > 0:
+  logger.warning("Per-domain config for unknown domains ignored: {}".format(', '.join(routing.unknown)))
+
+# Log table writes run on this thread while the records are processed
+log_executor = ThreadPoolExecutor(max_workers=1)
+
+# SES sends of the recipient chunks of a vmail run on these threads
+send_executor = ThreadPoolExecutor(max_workers=max(config.get_value('send_concurrency'), 1))
+startup.mark('handler setup')
+
+
+def send_raw_email(raw, destinations):
+  ses = clients.get_client('ses')
+  response = ses.send_raw_email(Destinations=destinations, RawMessage={ 'Data': raw })
   return response
 
 
+def chunk_recipients(recipients, size):
+  # SES accepts at most 50 destinations per message
+  size = max(size, 1)
+  return [ recipients[i:i + size] for i in range(0, len(recipients), size) ]
+
+
 def get_email_from_s3(bucket, key):
-  s3  = boto3.client('s3')
+  s3  = clients.get_client('s3')
   obj = s3.get_object(Bucket=bucket, Key=key)
-  return obj['Body'].read().decode()
+  return obj['Body'].read()
 
-  
-def reconstruct_email(text, sender, recipients, returnpath, headers = {}):
-  t = text.split("\n")
+
+def get_inline_content(msg):
+  # An SES SNS action puts the whole message in the notification, an S3
+  # action only its location
+  content = msg.get('content')
+  if content is None:
+    return None
+  if msg['receipt']['action'].get('encoding', 'UTF8').upper() == 'BASE64':
+    return base64.b64decode(content)
+  return content.encode()
+
+
+# Original headers that are carried over to the forwarded message
+_preserved_header = re.compile(
+  rb'(?:Subject|Content-Transfer-Encoding|MIME-Version|Content-Type):',
+  re.IGNORECASE
+)
+_header_end = re.compile(rb'(\r?\n)\r?\n')
+_header_line = re.compile(rb'[^\n]*\n|[^\n]+$')
+_eol = re.compile(rb'\r?\n')
+
+
+def parse_email(data):
+  # Only the header block is scanned; the body is returned as a memoryview 
+  # slice of the original bytes, so it is never decoded or copied and 
+  # messages that are not valid utf-8 pass thru untouched
+  m = _eol.match(data)
+  if m is not None:
+    # Message starts with the empty line, there are no headers
+    header_block, end, eol = b'', m.end(), m.group(0)
+  else:
+    m = _header_end.search(data)
+    if m is not None:
+      header_block, end, eol = data[:m.end(1)], m.end(), m.group(1)
+    else:
+      m = _eol.search(data)
+      header_block, end = data, len(data)
+      eol = m.group(0) if m is not None else b'\r\n'
+
+  kept = []
+  keep = False
+  for line in _header_line.findall(header_block):
+    if line[:1] in (b' ', b'\t'):
+      # Folded continuation of the previous header
+      if keep is True:
+        kept.append(line)
+    else:
+      keep = _preserved_header.match(line) is not None
+      if keep is True:
+        kept.append(line)
+
+  if len(kept) > 0 and not kept[-1].endswith(b'\n'):
+    kept.append(eol)
+  kept.append(eol)
+
+  return (b''.join(kept), memoryview(data)[end:], eol)
+
+
+def reconstruct_email(parsed, sender, recipients, returnpath, headers = {}):
+  kept, body, eol = parsed
   result = []
   result.append('From: '+sender)
   result.append('To: ' + ', '.join(recipients))
@@ -74,44 +225,12 @@ def reconstruct_email(text, sender, recipients, returnpath, headers = {}):
   for k, v in headers.items():
     result.append("{}: {}".format(k, v))
 
-  i = 0
-  for s in t:
-    i += 1
-    if (re.match('Subject:', s, re.IGNORECASE) or
-        re.match('Content-Transfer-Encoding:', s, re.IGNORECASE) or
-        re.match('MIME-Version:', s, re.IGNORECASE)):
-      result.append(s.rstrip())
-    elif re.match('Content-Type:', s, re.IGNORECASE):
-      result.append(s.rstrip())
-      for _s in t[i:]:
-        if re.match(r'^\s', _s):
-          result.append(_s.rstrip())
-        else:
-          break
-    elif len(s.strip()) == 0:
-      result.append('')
-      break
-
-  for s in t[i:]:
-    result.append(s)
+  s = eol.decode().join(result) + eol.decode()
     
-  return '\n'.join(result)
-
+  return b''.join([ s.encode(), kept, body ])
 
-def get_value_for_domain(d, dest_domain):
-  if not isinstance(d, dict):
-    return None
-  
-  if dest_domain is not None and dest_domain in d.keys():
-    return d[dest_domain]
-  else:
-    if '%' in d:
-      return d['%']
-      
-  return None
-  
 
-def log_to_ddb(email_date, sender, recipients, subject, s3key, s3bucket, messageid=None):           
+def log_to_ddb(writer, email_date, sender, recipients, subject, s3key, s3bucket, messageid=None):           
 
   if s3key is None or s3bucket is None:
     _id = messageid
@@ -132,10 +251,95 @@ def log_to_ddb(email_date, sender, recipients, subject, s3key, s3bucket, message
   if _path is not None:
     item['s3_location'] = _path
   
+  # Written in batches off the critical path, see LogWriter
+  writer.add(item)
+
+
+# A send that was claimed but not confirmed within send_claim_timeout 
+# seconds is considered to have died with its invocation and may be claimed
+# again. It has to be longer than the handler Timeout so that a live send 
+# is never claimed twice, and shorter than the visibility timeout of the
+# inject queue so that the redelivered record finds the claim stale.
+
+# SES errors that a retry of the same message can not fix
+PERMANENT_SES_ERRORS = frozenset([
+  'MessageRejected',
+  'MailFromDomainNotVerifiedException',
+  'ConfigurationSetDoesNotExistException',
+  'InvalidParameterValue'
+])
+
+
+def is_permanent_ses_error(e):
+  response = getattr(e, 'response', None)
+  if not isinstance(response, dict):
+    return False
+  return response.get('Error', {}).get('Code') in PERMANENT_SES_ERRORS
+
+
+def get_send_id(messageid, vmail, chunk=0):
+  # The first chunk keeps the id of an unchunked send
+  send_id = '{}/{}'.format(messageid, vmail.lower())
+  return send_id if chunk == 0 else '{}#{}'.format(send_id, chunk)
+
+
+def claim_send(send_id):
+  # Conditional put keyed on the message id (X-Virtualmail-Id) and vmail;
+  # returns False if the message has already been sent to this vmail by an
+  # earlier delivery attempt of the same record, and None if another 
+  # attempt claimed it recently and may still be sending
+  tablename = config.get_value('ddb_tablename_sent')
+  if len(tablename) == 0 or send_id is None:
+    return True
+
+  from botocore.exceptions import ClientError
+
+  now = int(time.time())
+  item = {
+    'id':      send_id,
+    'status':  'sending',
+    'claimed': now,
+    'ttl':     now + config.get_value('sent_ttl_days') * 86400
+  }
+
   try:
-    ddb.put_item(config.get_value('ddb_tablename_log'), item)
-  except Exception as e:
-    raise PassthroughException(e, '_ddb_put_item()', text=json.dumps(item))
+    ddb.get_table(tablename).table.put_item(
+      Item=item,
+      ConditionExpression='attribute_not_exists(id) OR (#s = :sending AND #c < :stale)',
+      ExpressionAttributeNames={ '#s': 'status', '#c': 'claimed' },
+      ExpressionAttributeValues={ 
+        ':sending': 'sending', 
+        ':stale':   now - config.get_value('send_claim_timeout')
+      },
+      ReturnValuesOnConditionCheckFailure='ALL_OLD'
+    )
+  except ClientError as e:
+    if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+      old = e.response.get('Item', {})
+      if old.get('status', {}).get('S') == 'sent':
+        return False
+      return None
+    raise
+
+  return True
+
+
+def finish_send(send_id, sent):
+  tablename = config.get_value('ddb_tablename_sent')
+  if len(tablename) == 0 or send_id is None:
+    return
+
+  table = ddb.get_table(tablename).table
+  if sent is True:
+    table.update_item(
+      Key={ 'id': send_id },
+      UpdateExpression='SET #s = :sent',
+      ExpressionAttributeNames={ '#s': 'status' },
+      ExpressionAttributeValues={ ':sent': 'sent' }
+    )
+  else:
+    # Release the claim so that a retry can send the message
+    table.delete_item(Key={ 'id': send_id })
 
 
 def listsafe_str(o):
@@ -143,253 +347,546 @@ def listsafe_str(o):
 
 ##############################################################################  
 
-def handle_event(event):
-  print(json.dumps(event))
+def parse_record(_event):
+  eventsource = None
+  for x in ['EventSource', 'eventSource']:
+    if x in _event:
+      eventsource = _event[x]
+      break
+    
+  if eventsource == 'aws:sqs':
+    _msg = _event['body']
+  elif eventsource == 'aws:sns':
+    _msg = _event['Sns']['Message']   
 
-  for _event in event['Records']:
-    eventsource = None
-    for x in ['EventSource', 'eventSource']:
-      if x in _event:
-        eventsource = _event[x]
-        break
-      
+    
+  # Malformed records are reported to admins and consumed; retrying them
+  # would never succeed
+  try:
+    msg  = json.loads(_msg)
+  except Exception as e:
+    utils.handle_exception(
+      logger,
+      e, 
+      'converting event body to json',
+      text=json.dumps(_event, indent=4)
+    )
+    return None
+
+  headers = {}
+
+  try:
     if eventsource == 'aws:sqs':
-      _msg = _event['body']
+      for x in ['subject', 'to', 'from', 'body']:
+        if x not in msg:
+          print("Item {} missing from sqs json".format(x))
+          continue
+      
+      mail_subject    = msg['subject']
+      mail_recipients = { 'to': msg['to'] } 
+      mail_from       = msg['from']
+      mail_date       = datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S +0000")
+      s3key           = None
+      s3bucket        = None
+      messageid       = _event["messageId"]
+      destinations    = [ msg['to'] ]
+      email_body      = ("\n" + msg['body']).encode()
+      
+      _headers        = msg["headers"] if "headers" in msg else None
+      hops            = get_hops(_headers)
+      
+      headers["Subject"] = mail_subject
+      headers["Date"]    = mail_date
+    
+      if isinstance(_headers, dict):
+        for k, v in _headers.items():
+          if k.lower() in ['to', 'from', 'subject', HOPS_HEADER.lower()]:
+            continue
+          headers[k] = v
+      
     elif eventsource == 'aws:sns':
-      _msg = _event['Sns']['Message']   
+
+      mail_subject    = msg['mail']['commonHeaders']['subject']
+      mail_recipients = { 'to': msg['mail']['commonHeaders']['to'] } 
+      mail_from       = msg['mail']['commonHeaders']['from'][0]
+      mail_date       = msg['mail']['commonHeaders']['date']
+      s3key           = msg['receipt']['action'].get('objectKey')
+      s3bucket        = msg['receipt']['action'].get('bucketName')
+      messageid       = msg['mail']['messageId']
+      destinations    = msg['mail']['destination']
+      email_body      = get_inline_content(msg)
+      hops            = get_hops(msg['mail'].get('headers'))
       
-    try:
-      msg  = json.loads(_msg)
-    except Exception as e:
-      utils.handle_exception(
-        e, 
-        'converting event body to json',
-        text=json.dumps(_event, indent=4)
-      )
-      continue
+  except Exception as e:
+    utils.handle_exception(
+      logger,
+      e,
+      'processing mail parameters',
+      text=json.dumps(_event, indent=4)
+    )
+    return None
 
-    headers = {}
 
-    try:
-      if eventsource == 'aws:sqs':
-        for x in ['subject', 'to', 'from', 'body']:
-          if x not in msg:
-            print("Item {} missing from sqs json".format(x))
+  if (
+    'mail' in msg and 
+    'messageId' in msg['mail'] and 
+    msg['mail']['messageId'] == 'AMAZON_SES_SETUP_NOTIFICATION'
+  ):
+    # These messages do not need to be processed
+    return None
+
+  return {
+    'record_id':       get_record_id(_event),
+    'raw':             _msg,
+    'headers':         headers,
+    'mail_subject':    mail_subject,
+    'mail_recipients': mail_recipients,
+    'mail_from':       mail_from,
+    'mail_date':       mail_date,
+    's3key':           s3key,
+    's3bucket':        s3bucket,
+    'messageid':       messageid,
+    'destinations':    destinations,
+    'email_body':      email_body,
+    'hops':            hops
+  }
+
+
+def get_record_id(_event):
+  # Only SQS records can be reported as individual batch item failures
+  if _event.get('eventSource') == 'aws:sqs':
+    return _event['messageId']
+  return None
+
+
+def resolve_addresses(book, messages):
+  # Fetch every vmail addressed by the whole batch and the vmails nested in
+  # their recipients, down to max_nesting_depth, with one batched DynamoDB
+  # round trip per nesting level
+  level = []
+  for m in messages:
+    for dest in m['destinations']:
+      if routing.is_ours(dest):
+        level.append(dest)
+
+  fetched = set()
+  for depth in range(config.get_value('max_nesting_depth') + 1):
+    level = [ x for x in dict.fromkeys([ x.lower() for x in level ]) if x not in fetched ]
+    if len(level) == 0:
+      break
+    fetched.update(level)
+
+    nested = []
+    for item in book.prefetch(level).values():
+      if item is None:
+        continue
+      for rec in json.loads(item['recipients']):
+        if routing.is_ours(rec):
+          nested.append(rec)
+    level = nested
+
+
+def is_blocked(item, mail_from):
+  # for a mananged account, a password reset email is not allowed to 
+  # pass through to recipients; being non-managed must be explicit
+  return (
+    re.search("password-reset-noreply@aws.amazon.com", 
+    mail_from, 
+    re.IGNORECASE
+  ) and ('managed' not in item or item['managed'] != False))
+
+
+def get_recipients(book, vmail, mail_from, metrics):
+  # Vmails in the recipients are expanded to their own recipients here 
+  # instead of sending the message to them through SES for another pass.
+  # The walk goes one nesting level at a time with one batched lookup per
+  # level (usually served by resolve_addresses), each vmail is expanded at
+  # most once which also breaks cycles, and vmails nested deeper than 
+  # max_nesting_depth are dropped. Every expanded vmail, the addressed one
+  # included, adds the master_email of its domain, which is expanded in 
+  # turn if it is one of our vmails so that nothing goes back through SES.
+  max_depth = config.get_value('max_nesting_depth')
+
+  recipients = []
+  seen = set()
+  expanded = set([ vmail.lower() ])
+  level = [ vmail ]
+  depth = 0
+
+  while len(level) > 0:
+    book.prefetch(level)
+    nested = []
+
+    for v in level:
+      item = book.get(v)
+      if item is None and depth > 0:
+        # Not found so we'll block this address out to make sure
+        # there are no bounces
+        metrics.add('missing_recipients', 1)
+        metrics.add('filtered_recipients', 1)
+        _s = "Recipient {} is in one of our virtualmail domains but " \
+            "such vmail address does not exist"
+        logger.info(_s.format(v))
+        logger.info("Recipient {} filtered out".format(v))
+        continue
+
+      if depth > 0:
+        metrics.add('nested_vmails', 1)
+
+      _recipients = []
+      if item is not None and not is_blocked(item, mail_from):
+        _recipients += json.loads(item['recipients'])
+      # The master gets the message even if the vmail itself does not exist
+      # or blocks it
+      _recipients.append(routing.get(v).master_email)
+
+      for rec in _recipients:
+        if rec is None:
+          continue
+
+        # Filter out email eddresses that we don't want to actually 
+        # send any email (for example test domains, etc.)
+        if email_filter.match(rec):
+          metrics.add('filtered_recipients', 1)
+          logger.info("Recipient {} filtered out".format(rec))
+
+        elif routing.is_ours(rec):
+          if rec.lower() in expanded:
+            continue
+          expanded.add(rec.lower())
+
+          if depth >= max_depth:
+            metrics.add('depth_exceeded', 1)
+            logger.warning("Recipient {} of {} is nested deeper than {} levels, dropped".format(
+              rec, 
+              v,
+              max_depth
+            ))
             continue
-        
-        mail_subject    = msg['subject']
-        mail_recipients = { 'to': msg['to'] } 
-        mail_from       = msg['from']
-        mail_date       = datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S +0000")
-        s3key           = None
-        s3bucket        = None
-        messageid       = _event["messageId"]
-        destinations    = [ msg['to'] ]
-        email_body      = "\n" + msg['body']
-        
-        _headers        = msg["headers"] if "headers" in msg else None
-        
-        headers["Subject"] = mail_subject
-        headers["Date"]    = mail_date
+          nested.append(rec)
+
+        elif rec.lower() not in seen:
+          seen.add(rec.lower())
+          recipients.append(rec)
+
+    level = nested
+    depth += 1
+
+  return recipients
+
+
+def handle_message(m, book, log_writer):
+  # Returns False if the record failed in a way that a retry may fix
+  _msg            = m['raw']
+  mail_subject    = m['mail_subject']
+  mail_recipients = m['mail_recipients']
+  mail_from       = m['mail_from']
+  mail_date       = m['mail_date']
+  s3key           = m['s3key']
+  s3bucket        = m['s3bucket']
+  messageid       = m['messageid']
+  email_body      = m['email_body']
+  metrics         = m['metrics']
+
+  # Everything that belongs to the message itself (log entry, message body
+  # and its parsed headers) is handled once; only routing and sending is 
+  # done per destination
+  vmails = []
+  seen = set()
+  try:
+    for dest in m['destinations']:
+      route = routing.get(dest)
+      if route is not None and dest.lower() not in seen:
+        seen.add(dest.lower())
+        vmails.append((dest, route))
+      # else not our domain -> skip
+
+    if len(vmails) == 0:
+      return True
+
+    metrics.add('vmails', len(vmails))
+
+    if m['hops'] >= config.get_value('max_hops'):
+      # We have forwarded this message before and it came back
+      metrics.add('loops', 1)
+      logger.warning("Message {} has been forwarded {} times already, dropped to break a loop (From: {}, To: {})".format(
+        messageid,
+        m['hops'],
+        mail_from,
+        listsafe_str([ x for x, _ in vmails ])
+      ))
+      return True
+
+    if routing.print_mail_info is True:
+      logger.info("{dash} New email {dash}".format(dash="-"*30))
+      logger.info("From:    " + mail_from)
+      logger.info("To:      " + listsafe_str(mail_recipients["to"]))
+      logger.info("Date:    " + mail_date)
+      logger.info("Subject: " + mail_subject)
+      logger.info("Vmail:   " + listsafe_str([ x for x, _ in vmails ]))
+      logger.info("Msg:     s3://{}/{}".format(s3bucket, s3key))
+
+  except Exception as e:
+    utils.handle_exception(
+      logger,
+      e, 
+      'looking for destination and s3 values from message'
+    )
+    return True
+  
+  try:
+    with metrics.timer('log_write'):
+      log_to_ddb(
+        log_writer,
+        mail_date, 
+        mail_from, 
+        mail_recipients, 
+        mail_subject, 
+        s3key, 
+        s3bucket,
+        messageid
+      )
+  except Exception as e:
+    utils.handle_exception(logger, e, 'log inbound email to log ddb', text=_msg)
       
-        if isinstance(_headers, dict):
-          for k, v in _headers.items():
-            if k.lower() in ['to', 'from', 'subject']:
-              continue
-            headers[k] = v
-        
-      elif eventsource == 'aws:sns':
-
-        mail_subject    = msg['mail']['commonHeaders']['subject']
-        mail_recipients = { 'to': msg['mail']['commonHeaders']['to'] } 
-        mail_from       = msg['mail']['commonHeaders']['from'][0]
-        mail_date       = msg['mail']['commonHeaders']['date']
-        s3key           = msg['receipt']['action']['objectKey']
-        s3bucket        = msg['receipt']['action']['bucketName']
-        messageid       = msg['mail']['messageId']
-        destinations    = msg['mail']['destination']
-        email_body      = None
-        
+  # Routing is decided from the notification metadata alone so that the 
+  # message body is only downloaded when something will actually be sent
+  routes = []
+  ok = True
+  for vmail, route in vmails:
+    try:
+      with metrics.timer('ddb_lookup'):
+        recipients = get_recipients(book, vmail, mail_from, metrics)
     except Exception as e:
       utils.handle_exception(
+        logger,
         e,
-        'processing mail parameters',
-        text=json.dumps(_event, indent=4)
+        'doing ddb lookup for virtualemail',
+        text=_msg
       )
+      ok = False
       continue
-  
+    
+    if routing.print_mail_info is True:
+      logger.info("Recipients for {}: {}".format(vmail, listsafe_str(recipients)))
 
-    if (
-      'mail' in msg and 
-      'messageId' in msg['mail'] and 
-      msg['mail']['messageId'] == 'AMAZON_SES_SETUP_NOTIFICATION'
-    ):
-      # These messages do not need to be processed
+    if len(recipients) == 0:
+      logger.info("No recipients, no email!")
       continue
-  
-    dest_domain = None
-    vmail = None
-
-    for dest in destinations:
-      try:
-        dest_domain = dest.split('@')[1]
-        if dest_domain in config.get_value("email_domains"):
-          vmail = dest
-        else:
-          # not our domain -> skip
-          continue
-      
-        if vmail is None:
-          vmail = get_value_for_domain(
-            config.get_value("default_sender"), 
-            dest_domain
-        )
-
-        if config.get_value("print_mail_info") is True:
-          logger.info("{dash} New email {dash}".format(dash="-"*30))
-          logger.info("From:    " + mail_from)
-          logger.info("To:      " + listsafe_str(mail_recipients["to"]))
-          logger.info("Date:    " + mail_date)
-          logger.info("Subject: " + mail_subject)
-          logger.info("Vmail:   " + vmail)
-          logger.info("Msg:     s3://{}/{}".format(s3bucket, s3key))
-
-      except Exception as e:
-        utils.handle_exception(
-          logger,
-          e, 
-          'looking for destination and s3 values from message'
-        )
-        continue
-      
-      try:
-        log_to_ddb(
-          mail_date, 
-          mail_from, 
-          mail_recipients, 
-          mail_subject, 
-          s3key, 
-          s3bucket,
-          messageid
-        )
-      except PassthroughException as e:
-        t = e.text + "\n\n" + _msg if e.text is not None else _msg
-        utils.handle_exception(logger, e.e, e.when, text=t)
-      except Exception as e:
-        utils.handle_exception(logger, e, 'log inbound email to log ddb', text=_msg)
-          
-      if s3bucket is not None and s3key is not None:
-        try:
-          t = get_email_from_s3(s3bucket, s3key)
-        except Exception as e:
-          utils.handle_exception(e, 'retrieving email from s3', text=_msg)
-          continue
-      else:
-        t = email_body
-
-      efilters = config.get_value("email_filter")
-      recipients = []
-      try:
-        item = ddb.get_item(
-          config.get_value('ddb_tablename'),
-          'virtualemail',
-          vmail.lower()
-        )
-        if item is not None:
-          if (
-            re.search("password-reset-noreply@aws.amazon.com", 
-            mail_from, 
-            re.IGNORECASE
-          ) and ('managed' not in item or item['managed'] != False)):
-            # for a mananged account, a password reset email is not allowed to 
-            # pass through to recipients; being non-managed must be explicit
-            pass
-          else:
-            j = json.loads(item['recipients'])
-
-            for rec in j:
-              filter_out = False
-              
-              # Filter out email eddresses that we don't want to actually 
-              # send any email (for example test domains, etc.)
-              for efilter in efilters:
-                if re.search(efilter, rec):
-                  filter_out = True
-                  break
-                
-              # Check if the email address belongs to one of our managed domains
-              # and if it does, that the vmail actually exists
-              if filter_out is False:
-                recdom = rec.split('@')[1]
-
-                if recdom in config.get_value("email_domains"):
-                  item = ddb.get_item(
-                    config.get_value('ddb_tablename'),
-                    'virtualemail',
-                    rec.lower()
-                  )
-
-                  if item is None:
-                    # Not found so we'll block this address out to make sure
-                    # there are no bounces
-                    filter_out = True
-                    _s = "Recipient {} is in one of our virtualmail domains but " \
-                        "such vmail address does not exist"
-                    logger.info(_s.format(rec))
-                
-              if filter_out is False and rec not in recipients:
-                recipients.append(rec)
-
-              elif filter_out is True:
-                logger.info("Recipient {} filtered out".format(rec))
-                
-      except Exception as e:
-        utils.handle_exception(
-          logger,
-          e,
-          'doing ddb lookup for virtualemail',
-          text=_msg
-        )
-        continue
-      
-      master_email = get_value_for_domain(
-        config.get_value("master_email"), 
-        dest_domain
-      )
-      
-      if (master_email is not None and master_email not in recipients):
-        recipients.append(master_email)
-      
-      if config.get_value("print_mail_info") is True:
-        logger.info("Recipients: " + listsafe_str(recipients))    
-      
-      bounces_email = get_value_for_domain(
-        config.get_value("bounces_email"), 
-        dest_domain
-      )    
-
-      headers["X-Virtualmail-Original-From"] = mail_from 
-      if messageid is not None:
-        headers["X-Virtualmail-Id"] = messageid
-      
-      try:
-        raw = reconstruct_email(t, vmail, recipients, bounces_email, headers)
-      except Exception as e:
-        utils.handle_exception(logger, e, 'reconstructing email', text=_msg)
-        continue
-      
-      try:
-        if len(recipients) > 0:
-          send_raw_email(raw)
-        else:
-          logger.info("No recipients, no email!")
-      except Exception as e:
-        utils.handle_exception(logger, e, 'sending email', text=_msg)
+    
+    metrics.add('recipients', len(recipients))
+    routes.append((vmail, recipients, route.bounces_email))
+
+  if len(routes) == 0:
+    return ok
+
+  if email_body is not None:
+    t = email_body
+  elif s3bucket is not None and s3key is not None:
+    try:
+      with metrics.timer('s3_fetch'):
+        t = get_email_from_s3(s3bucket, s3key)
+    except Exception as e:
+      utils.handle_exception(logger, e, 'retrieving email from s3', text=_msg)
+      return False
+  else:
+    logger.error("No content or S3 location for message {}".format(messageid))
+    return True
+
+  metrics.add('message_size', len(t), BYTES)
+
+  try:
+    with metrics.timer('parse_email'):
+      parsed = parse_email(t)
+  except Exception as e:
+    utils.handle_exception(logger, e, 'parsing email', text=_msg)
+    return ok
+
+  headers = { **m['headers'] }
+  headers["X-Virtualmail-Original-From"] = mail_from 
+  if messageid is not None:
+    headers["X-Virtualmail-Id"] = messageid
+  headers[HOPS_HEADER] = str(m['hops'] + 1)
+
+  for vmail, recipients, bounces_email in routes:
+    # Recipients are sent to in SES sized chunks with explicit destinations,
+    # all chunks share the same message; a list that needs more than one 
+    # chunk is addressed to the vmail itself like a mailing list
+    chunks = chunk_recipients(recipients, config.get_value('ses_max_recipients'))
+    to = recipients if len(chunks) == 1 else [ vmail ]
+    try:
+      with metrics.timer('reconstruct'):
+        raw = reconstruct_email(parsed, vmail, to, bounces_email, headers)
+    except Exception as e:
+      utils.handle_exception(logger, e, 'reconstructing email', text=_msg)
+      continue
+
+    metrics.add('chunks', len(chunks))
+    sends = [
+      (get_send_id(messageid, vmail, i) if messageid is not None else None, chunk)
+      for i, chunk in enumerate(chunks)
+    ]
+    if len(sends) > 1:
+      results = list(send_executor.map(
+        lambda x: send_chunk(raw, vmail, x[0], x[1], messageid, metrics, _msg),
+        sends
+      ))
+    else:
+      results = [ send_chunk(raw, vmail, x[0], x[1], messageid, metrics, _msg) for x in sends ]
+
+    if False in results:
+      ok = False
+
+  return ok
+
+
+def send_chunk(raw, vmail, send_id, destinations, messageid, metrics, _msg):
+  # Returns False if the chunk should be retried
+  try:
+    with metrics.timer('send_claim'):
+      claimed = claim_send(send_id)
+    if claimed is False:
+      logger.info("Message {} already sent to {} ({} recipients), skipping".format(
+        messageid, vmail, len(destinations)
+      ))
+      return True
+    if claimed is None:
+      # Retried once the claim has gone stale, in case its owner died
+      logger.warning("Message {} to {} ({} recipients) is being sent by another attempt, retrying later".format(
+        messageid, vmail, len(destinations)
+      ))
+      return False
+  except Exception as e:
+    utils.handle_exception(logger, e, 'claiming message for sending', text=_msg)
+    return False
+
+  try:
+    with metrics.timer('ses_send'):
+      send_raw_email(raw, destinations)
+  except Exception as e:
+    utils.handle_exception(logger, e, 'sending email', text=_msg)
+    try:
+      finish_send(send_id, False)
+    except Exception as e:
+      utils.handle_exception(logger, e, 'releasing send claim', text=_msg)
+    if is_permanent_ses_error(e):
+      # Reported above; retrying would only repeat the error and the report
+      metrics.add('rejected', 1)
+      return True
+    return False
+
+  metrics.add('sent', 1)
+  try:
+    finish_send(send_id, True)
+  except Exception as e:
+    # The message went out; worst case the unconfirmed claim goes stale and
+    # a retry of the same record sends it again
+    utils.handle_exception(logger, e, 'confirming send claim', text=_msg)
+  return True
+
+
+def handle_message_safe(m, book, log_writer):
+  try:
+    with m['metrics'].timer('handle'):
+      return handle_message(m, book, log_writer)
+  except Exception as e:
+    utils.handle_exception(logger, e, 'handle_message', text=m['raw'])
+    return False
+
+
+def handle_event(event):
+  # Returns the record ids of the SQS records that failed
+  if should_dump(config.get_value('event_dump_rate')):
+    print(json.dumps(event))
+
+  messages = []
+  for _event in event['Records']:
+    metrics = Metrics('handler')
+    with metrics.timer('parse'):
+      m = parse_record(_event)
+    if m is not None:
+      m['metrics'] = metrics
+      metrics.set_property('messageid', m['messageid'])
+      messages.append(m)
+
+  book = AddressBook(ddb, config.get_value('ddb_tablename'), cache=address_cache)
+  log_writer = LogWriter(
+    ddb, 
+    config.get_value('ddb_tablename_log'),
+    ttl_days=config.get_value('log_ttl_days'),
+    executor=log_executor
+  )
+
+  # Batch level stages are shared by the records of the batch and are
+  # reported with each of them
+  batch = Metrics('handler')
+  try:
+    with batch.timer('ddb_prefetch'):
+      resolve_addresses(book, messages)
+  except Exception as e:
+    # Not fatal; addresses that were not prefetched are looked up one by one
+    utils.handle_exception(logger, e, 'prefetching virtualemail addresses')
+
+  concurrency = min(config.get_value('handler_concurrency'), len(messages))
+
+  # A FIFO queue must get the failed record and every record after it back
+  fifo = any([ x.get('eventSourceARN', '').endswith('.fifo') for x in event['Records'] ])
+
+  if concurrency > 1:
+    # Records are independent of each other, so their S3, DynamoDB and SES
+    # calls can overlap; errors stay isolated per record
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+      results = list(executor.map(lambda m: handle_message_safe(m, book, log_writer), messages))
+  else:
+    results = []
+    for m in messages:
+      if fifo and False in results:
+        # Not processed, delivered again after the failed record
+        results.append(None)
         continue
+      results.append(handle_message_safe(m, book, log_writer))
+
+  retry = [ ok is False for ok in results ]
+  if fifo and True in retry:
+    first = retry.index(True)
+    retry = retry[:first] + [ True ] * (len(retry) - first)
+
+  # Log entries are not worth retrying the records for
+  with batch.timer('log_flush'):
+    log_errors = log_writer.flush()
+  for e, items in log_errors:
+    utils.handle_exception(logger, e, '_ddb_batch_write_item()', text=json.dumps(items))
+
+  for m, ok in zip(messages, results):
+    m['metrics'].update(batch)
+    m['metrics'].add('batch_size', len(messages))
+    m['metrics'].add('failed', 1 if ok is False else 0)
+    m['metrics'].add('deferred', 1 if ok is None else 0)
+    m['metrics'].emit()
+
+  return [ 
+    m['record_id'] for m, failed in zip(messages, retry) 
+    if failed is True and m['record_id'] is not None 
+  ]
 
 
 def lambda_handler(event, context):
+  startup.report(logger)
+  if is_warmup(event):
+    return warm_up(logger, event, [ 'dynamodb', 's3', 'ses', 'sns' ])
+
   try:
-    handle_event(event)
+    failures = handle_event(event)
   except Exception as e:
-    utils.handle_exception(logger, e, 'handle_event', text=json.dumps(event))
\ No newline at end of file
+    utils.handle_exception(logger, e, 'handle_event', text=json.dumps(event))
+    failures = [ 
+      x for x in [ get_record_id(_event) for _event in event.get('Records', []) ]
+      if x is not None
+    ]
+
+  utils.flush_errors()
+
+  # With ReportBatchItemFailures only the failed SQS records are retried
+  return { 
+    'batchItemFailures': [ { 'itemIdentifier': x } for x in failures ] 
+  }
@@ -0,0 +1,129 @@
+import json
+
+from .common import clients, utils
+from .common.batch import batch_delete_items, batch_write_items
+
+from anlogger import Logger
+_logger = Logger("virtualmail-reindex", 'INFO')
+logger = _logger.get()
+
+ddb = clients.Lazy(clients.get_ddb)
+
+from anenvconf import Config
+config_schema = {
+  'ddb_tablename': {},
+  'ddb_tablename_reverse': {
+    'default': ''
+  },
+  'sns_admin': {}
+}
+
+config = Config(config_schema)
+
+
+def scan_table(tablename, projection):
+  table = ddb.get_table(tablename).table
+  params = { 'ProjectionExpression': projection }
+
+  while True:
+    response = table.scan(**params)
+    for item in response['Items']:
+      yield item
+
+    if 'LastEvaluatedKey' not in response:
+      break
+    params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def scan_addresses(tablename):
+  # Returns the reverse index entries of every address and the addresses
+  # that have no vmail_domain yet (written before the domain index existed)
+  entries = set()
+  missing_domain = []
+  for item in scan_table(tablename, 'virtualemail, recipients, vmail_domain'):
+    if 'vmail_domain' not in item:
+      missing_domain.append(item['virtualemail'])
+
+    try:
+      recipients = json.loads(item['recipients'])
+    except Exception as e:
+      utils.handle_exception(logger, e, 'decoding recipients', text=json.dumps(item))
+      continue
+
+    for recipient in recipients:
+      entries.add((recipient.lower(), item['virtualemail']))
+
+  return entries, missing_domain
+
+
+def set_vmail_domains(tablename, virtualemails):
+  # Sets the domain index key like add and modify of the API do; addresses
+  # deleted or given a domain since the scan are left alone
+  from botocore.exceptions import ClientError
+
+  table = ddb.get_table(tablename).table
+  updated = 0
+  for virtualemail in virtualemails:
+    try:
+      table.update_item(
+        Key={ 'virtualemail': virtualemail },
+        UpdateExpression='SET vmail_domain = :d',
+        ConditionExpression='attribute_exists(virtualemail) AND attribute_not_exists(vmail_domain)',
+        ExpressionAttributeValues={ ':d': virtualemail.split('@')[1].lower() }
+      )
+      updated += 1
+    except ClientError as e:
+      if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+        raise
+  return updated
+
+
+def rebuild_reverse_index(tablename_reverse, wanted):
+  # Adds the missing entries and removes the stale ones
+  existing = set([
+    (x['recipient'], x['virtualemail'])
+    for x in scan_table(tablename_reverse, 'recipient, virtualemail')
+  ])
+
+  added = sorted(wanted - existing)
+  removed = sorted(existing - wanted)
+
+  unprocessed = batch_write_items(
+    ddb,
+    tablename_reverse,
+    [ { 'recipient': x, 'virtualemail': y } for x, y in added ],
+    keyname=['recipient', 'virtualemail']
+  )
+  unprocessed += batch_delete_items(
+    ddb,
+    tablename_reverse,
+    [ { 'recipient': x, 'virtualemail': y } for x, y in removed ]
+  )
+  if len(unprocessed) > 0:
+    raise Exception("{} reverse index entries left unprocessed".format(len(unprocessed)))
+
+  logger.info("Rebuilt reverse index, {} entries added and {} removed".format(
+    len(added),
+    len(removed)
+  ))
+  return { 'added': len(added), 'removed': len(removed) }
+
+
+def lambda_handler(event, context):
+  # Invoked manually to index addresses that existed before the domain or
+  # reverse index, or after addresses were edited directly in the table
+  try:
+    tablename = config.get_value('ddb_tablename')
+    tablename_reverse = config.get_value('ddb_tablename_reverse')
+
+    wanted, missing_domain = scan_addresses(tablename)
+
+    result = { 'domains_set': set_vmail_domains(tablename, missing_domain) }
+    logger.info("Set vmail_domain of {} addresses".format(result['domains_set']))
+
+    if len(tablename_reverse) > 0:
+      result.update(rebuild_reverse_index(tablename_reverse, wanted))
+    return result
+
+  except Exception as e:
+    utils.handle_exception(logger, e, 'reindexing addresses', stop_processing=True)
@@ -0,0 +1,61 @@
+from .common import clients, utils
+from .common.snapshot import SnapshotLoader, build_snapshot
+
+from anlogger import Logger
+_logger = Logger("virtualmail-snapshot", 'INFO')
+logger = _logger.get()
+
+ddb = clients.Lazy(clients.get_ddb)
+
+from anenvconf import Config
+config_schema = {
+  'ddb_tablename': {},
+  'sns_admin': {},
+  'address_snapshot': {}
+}
+
+config = Config(config_schema)
+
+
+def get_all_addresses(tablename):
+  table = ddb.get_table(tablename).table
+  params = { 'ProjectionExpression': 'virtualemail' }
+
+  result = []
+  while True:
+    response = table.scan(**params)
+    for item in response['Items']:
+      result.append(item['virtualemail'])
+
+    if 'LastEvaluatedKey' not in response:
+      break
+    params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+  return result
+
+
+def publish_snapshot(data, destination):
+  if destination.startswith('s3://'):
+    bucket, key = SnapshotLoader.get_bucket_and_key(destination)
+    s3 = clients.get_client('s3')
+    s3.put_object(Bucket=bucket, Key=key, Body=data)
+  else:
+    with open(destination, 'wb') as f:
+      f.write(data)
+
+
+def lambda_handler(event, context):
+  # Invoked by the virtualemail table's DynamoDB stream and on a schedule;
+  # the stream records only tell that something changed, the snapshot is 
+  # always rebuilt from a full (keys only) scan of the table
+  try:
+    addresses = get_all_addresses(config.get_value('ddb_tablename'))
+    data = build_snapshot(addresses)
+    publish_snapshot(data, config.get_value('address_snapshot'))
+    logger.info("Published address snapshot with {} addresses ({} bytes)".format(
+      len(addresses),
+      len(data)
+    ))
+  except Exception as e:
+    # Raise so that the stream batch is retried
+    utils.handle_exception(logger, e, 'building address snapshot', stop_processing=True)
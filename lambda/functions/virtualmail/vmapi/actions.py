@@ -1,25 +1,118 @@
+import base64
 import json
 import re
 
-from anawsutils import dynamodb
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
 from anenvconf import Config
 from anlogger import Logger
 
-ddb = dynamodb.DDB()
-
-from ..common import utils
+from ..common import clients, utils
+from ..common.batch import batch_delete_items, batch_get_items, batch_write_items
+from ..common.matchers import get_domain_matcher
+
+ddb = clients.Lazy(clients.get_ddb)
+
+# Upper limit for the number of entries in one batch request
+MAX_BATCH_ITEMS = 100
+
+# DynamoDB TransactWriteItems accepts at most 100 actions per call
+TRANSACT_MAX_ITEMS = 100
+
+# Conditional writes of a /batch-add run on this many threads
+BATCH_WRITE_CONCURRENCY = 10
+
+# /list parameters and the global secondary index and key attribute that
+# serve them
+LIST_INDEXES = {
+  'owner':  ('owner-index', 'owner'),
+  'domain': ('domain-index', 'vmail_domain')
+}
+MAX_LIST_LIMIT = 100
+
+# Writes that lose a race against another writer are retried this many 
+# times before giving up
+MAX_WRITE_ATTEMPTS = 3
+
+NOT_PROTECTED = '(attribute_not_exists(#p) OR #p = :false)'
+
+# Attributes for the API's own bookkeeping that are not returned to clients
+INTERNAL_ATTRIBUTES = [ 'version' ]
+
+def get_condition_failure(e):
+  # Returns (True, current item or None) if e is a failed write condition
+  # of a call made with ReturnValuesOnConditionCheckFailure=ALL_OLD and 
+  # (False, None) otherwise
+  # A write that failed has already imported botocore and boto3
+  from boto3.dynamodb.types import TypeDeserializer
+  from botocore.exceptions import ClientError
+
+  if not isinstance(e, ClientError):
+    return (False, None)
+
+  code = e.response['Error']['Code']
+  if code == 'ConditionalCheckFailedException':
+    item = e.response.get('Item')
+  elif code == 'TransactionCanceledException':
+    reasons = e.response.get('CancellationReasons', [])
+    if len(reasons) == 0 or reasons[0].get('Code') != 'ConditionalCheckFailed':
+      return (False, None)
+    item = reasons[0].get('Item')
+  else:
+    return (False, None)
+
+  if item is None:
+    return (True, None)
+  deserializer = TypeDeserializer()
+  return (True, { k: deserializer.deserialize(v) for k, v in item.items() })
+
+
+# Configuration values that Actions needs, resolved and parsed once per 
+# container by load_settings()
+Settings = namedtuple('Settings', [
+  'ddb_tablename',
+  'ddb_tablename_reverse',
+  'email_domains',
+  'owner_domains',
+  'recipient_domains',
+  'restricted_access_keys'
+])
+
+
+def load_settings(config: Config):
+  rak = {}
+  for apikeyid, domains in config.get_value("restricted_access_keys").items():
+    # An api key is restricted to one domain or to a list of domains
+    if isinstance(domains, str):
+      domains = [ domains ]
+    rak[apikeyid] = frozenset([ x.lower() for x in domains ])
+
+  return Settings(
+    ddb_tablename          = config.get_value("ddb_tablename"),
+    ddb_tablename_reverse  = config.get_value("ddb_tablename_reverse"),
+    email_domains          = frozenset([ x.lower() for x in config.get_value("email_domains") ]),
+    owner_domains          = config.get_value("owner_domains"),
+    recipient_domains      = config.get_value("recipient_domains"),
+    restricted_access_keys = rak
+  )
 
 
 class Actions(object):
-  def __init__(self, config: Config, apikeyid, logger: Logger):
-    self.config   = config
-    self.apikeyid = apikeyid
+  # Holds no per request state, a single instance serves every request of
+  # the container; the api key of a request is read from its event
+  def __init__(self, settings: Settings, logger: Logger):
     self.logger   = logger
     
-    self.ddb_tablename = config.get_value("ddb_tablename")
-    self.email_domains = config.get_value("email_domains")
-    self.owner_domains = config.get_value("owner_domains")
-    self.recipient_domains = config.get_value("recipient_domains")
+    self.ddb_tablename = settings.ddb_tablename
+    self.ddb_tablename_reverse = settings.ddb_tablename_reverse
+    self.email_domains = settings.email_domains
+    self.owner_domains = settings.owner_domains
+    self.recipient_domains = settings.recipient_domains
+    self.restricted_access_keys = settings.restricted_access_keys
+
+    self.owner_domain_matcher = get_domain_matcher(self.owner_domains)
+    self.recipient_domain_matcher = get_domain_matcher(self.recipient_domains)
     
 
   def handle_exception(self, e, when=None, text=None, stop_processing=False):
@@ -39,18 +132,23 @@ class Actions(object):
     return json.loads(event['body']) if 'body' in event else None
 
 
-  def validate_key_access(self, virtualemail_address):
+  @staticmethod
+  def get_apikeyid(event):
+    return event['requestContext']['identity']['apiKeyId']
+
+
+  def validate_key_access(self, virtualemail_address, apikeyid):
     x = virtualemail_address.split('@')
     if len(x) != 2 or x[1].lower() not in self.email_domains:
       return False
       
     vmail_domain = x[1].lower()
     
-    rak = self.config.get_value("restricted_access_keys")
-    if self.apikeyid not in rak.keys():
+    rak = self.restricted_access_keys
+    if apikeyid not in rak:
       return True
     
-    if vmail_domain in rak[self.apikeyid]:
+    if vmail_domain in rak[apikeyid]:
       return True
     else:  
       return False
@@ -78,9 +176,227 @@ class Actions(object):
     return None
 
 
-  def _action_add_or_modify(self, event, action):
-    data   = self._get_data(event)
+  @staticmethod
+  def _get_recipients(item):
+    return [] if item is None else json.loads(item['recipients'])
+
+
+  def _reverse_actions(self, virtualemail, old, new):
+    # TransactWriteItems actions that move the reverse index entries of a
+    # virtualemail from its old recipients to the new ones
+    actions = []
+    for x in sorted(set(new) - set(old)):
+      actions.append({ 'Put': { 
+        'TableName': self.ddb_tablename_reverse,
+        'Item':      { 'recipient': x, 'virtualemail': virtualemail }
+      } })
+    for x in sorted(set(old) - set(new)):
+      actions.append({ 'Delete': { 
+        'TableName': self.ddb_tablename_reverse,
+        'Key':       { 'recipient': x, 'virtualemail': virtualemail }
+      } })
+    return actions
+
+
+  def _transact(self, action, reverse_actions):
+    # The address item is always the first action, get_condition_failure()
+    # relies on that. Reverse index changes that do not fit in the same
+    # transaction (vmails with about a hundred recipients) are written 
+    # after it has succeeded
+    action['TableName'] = self.ddb_tablename
+    action['ReturnValuesOnConditionCheckFailure'] = 'ALL_OLD'
+    operation = 'Delete' if 'Key' in action else 'Put'
+    ddb.dynamodb.meta.client.transact_write_items(
+      TransactItems=[ { operation: action } ] + reverse_actions[:TRANSACT_MAX_ITEMS - 1]
+    )
+
+    overflow = reverse_actions[TRANSACT_MAX_ITEMS - 1:]
+    if len(overflow) > 0:
+      self._write_reverse_overflow(overflow)
+
+
+  def _write_reverse_overflow(self, reverse_actions):
+    # The address itself is already written, so failures here are only 
+    # reported; running the reindex function repairs the index
+    try:
+      unprocessed = batch_write_items(
+        ddb,
+        self.ddb_tablename_reverse,
+        [ x['Put']['Item'] for x in reverse_actions if 'Put' in x ],
+        keyname=['recipient', 'virtualemail']
+      )
+      unprocessed += batch_delete_items(
+        ddb,
+        self.ddb_tablename_reverse,
+        [ x['Delete']['Key'] for x in reverse_actions if 'Delete' in x ]
+      )
+      if len(unprocessed) > 0:
+        raise Exception("{} reverse index entries left unprocessed".format(len(unprocessed)))
+    except Exception as e:
+      self.handle_exception(
+        e, 
+        "writing reverse index entries outside the transaction; run the reindex function",
+        text=json.dumps(reverse_actions)
+      )
+
+
+  def _write_add(self, d):
+    # One conditional write; fails if the address already exists
+    item = dict(d, version=1)
+    condition = {
+      'ConditionExpression': 'attribute_not_exists(virtualemail)'
+    }
+
+    if len(self.ddb_tablename_reverse) == 0:
+      ddb.get_table(self.ddb_tablename).table.put_item(
+        Item=item,
+        ReturnValuesOnConditionCheckFailure='ALL_OLD',
+        **condition
+      )
+      return
+
+    self._transact(
+      dict(condition, Item=item),
+      self._reverse_actions(item['virtualemail'], [], self._get_recipients(item))
+    )
+
+
+  def _write_modify(self, changes):
+    # Returns False if the address does not exist
+    key = { 'virtualemail': changes['virtualemail'] }
+
+    if len(self.ddb_tablename_reverse) == 0:
+      # One conditional update that only sets the given attributes
+      names  = { '#p': 'protected', '#v': 'version' }
+      values = { ':false': False, ':one': 1 }
+      sets   = []
+      for i, x in enumerate(sorted(changes.keys())):
+        if x == 'virtualemail':
+          continue
+        names['#a{}'.format(i)] = x
+        values[':a{}'.format(i)] = changes[x]
+        sets.append('#a{0} = :a{0}'.format(i))
+
+      ddb.get_table(self.ddb_tablename).table.update_item(
+        Key=key,
+        UpdateExpression='SET {} ADD #v :one'.format(', '.join(sets)),
+        ConditionExpression='attribute_exists(virtualemail) AND ' + NOT_PROTECTED,
+        ExpressionAttributeNames=names,
+        ExpressionAttributeValues=values,
+        ReturnValuesOnConditionCheckFailure='ALL_OLD'
+      )
+      return
+
+    # The reverse index entries depend on the current recipients, so the
+    # item is read first and written back only if its version is still
+    # the same
+    r = ddb.get_item(self.ddb_tablename, 'virtualemail', key['virtualemail'])
+    if r is None:
+      return False
+
+    item = dict(r, **changes)
+    item['version'] = self._get_version(r) + 1
+
+    self._transact(
+      dict(self._unchanged_condition(r), Item=item),
+      self._reverse_actions(
+        item['virtualemail'], 
+        self._get_recipients(r), 
+        self._get_recipients(item)
+      )
+    )
+
+
+  def _write_delete(self, virtualemail, owner):
+    key = { 'virtualemail': virtualemail }
+    condition = 'attribute_exists(virtualemail) AND #o = :owner AND ' + NOT_PROTECTED
+    names = { '#o': 'owner', '#p': 'protected' }
+    values = { ':owner': owner, ':false': False }
+
+    if len(self.ddb_tablename_reverse) == 0:
+      ddb.get_table(self.ddb_tablename).table.delete_item(
+        Key=key,
+        ConditionExpression=condition,
+        ExpressionAttributeNames=names,
+        ExpressionAttributeValues=values,
+        ReturnValuesOnConditionCheckFailure='ALL_OLD'
+      )
+      return
+
+    r = ddb.get_item(self.ddb_tablename, 'virtualemail', virtualemail)
+    unchanged = self._unchanged_condition(r)
+    names.update(unchanged['ExpressionAttributeNames'])
+    values.update(unchanged['ExpressionAttributeValues'])
+
+    self._transact(
+      {
+        'Key':                       key,
+        'ConditionExpression':       condition + ' AND ' + unchanged['ConditionExpression'],
+        'ExpressionAttributeNames':  names,
+        'ExpressionAttributeValues': values
+      },
+      self._reverse_actions(virtualemail, self._get_recipients(r), [])
+    )
+
+
+  @staticmethod
+  def _public(item):
+    if item is None:
+      return None
+    return { k: v for k, v in item.items() if k not in INTERNAL_ATTRIBUTES }
+
+
+  @staticmethod
+  def _get_version(item):
+    return 0 if item is None or 'version' not in item else int(item['version'])
+
+
+  def _unchanged_condition(self, r):
+    # Condition for writing over the item r that was read earlier
+    condition = {
+      'ConditionExpression':       'attribute_exists(virtualemail) AND ' + NOT_PROTECTED,
+      'ExpressionAttributeNames':  { '#p': 'protected' },
+      'ExpressionAttributeValues': { ':false': False }
+    }
+
+    # Without r the condition fails as the address does not exist, unless 
+    # it was just created
+    if r is not None:
+      condition['ExpressionAttributeNames']['#v'] = 'version'
+      if 'version' not in r:
+        condition['ConditionExpression'] += ' AND attribute_not_exists(#v)'
+      else:
+        condition['ConditionExpression'] += ' AND #v = :version'
+        condition['ExpressionAttributeValues'][':version'] = self._get_version(r)
 
+    return condition
+
+
+  @staticmethod
+  def _condition_message(action, current, owner=None):
+    # Maps a failed write condition to the same messages that the checks
+    # of the current item produced before; None means that the item was 
+    # changed by someone else between reading and writing it
+    if action == 'add':
+      return "Virtual account already exists"
+
+    if current is None:
+      return "Virtual account does not exist"
+
+    if action == 'delete' and current['owner'] != owner:
+      return "Owner parameter does not match owner in database"
+
+    if 'protected' in current and current['protected'] != False:
+      if action == 'delete':
+        return "Virtual account is protected"
+      return "Virtualemail is protected"
+
+    return None
+
+
+  def _precheck_add_or_modify(self, data, action, apikeyid):
+    # Checks that do not need the current item; returns (code, result) on
+    # failure and None otherwise
     modify = (action == 'modify')
 
     if modify is True:
@@ -103,7 +419,7 @@ class Actions(object):
       result['message'] = "Virtualemail is not in the correct domain"
       return (200, result)
       
-    if self.validate_key_access(data['virtualemail']) is False:
+    if self.validate_key_access(data['virtualemail'], apikeyid) is False:
       result['status']  = "FAIL"
       result['message'] = "Virtualemail is not in an authorized domain"
       return (200, result)
@@ -112,43 +428,54 @@ class Actions(object):
       result['status']  = "FAIL"
       result['message'] = "Virtualemail is not a valid email address"
       return (200, result)
- 
-    try:
-      r = ddb.get_item(self.ddb_tablename, 'virtualemail', data['virtualemail'].lower())
-    except Exception as e:
-      self.handle_exception(e, "get data from ddb in get()", text=json.dumps(event))
-      result['status']  = "FAIL"
-      result['message'] = "Internal error (AAOMGD)"
-      return (200, result)
 
-    if modify is False and r is not None:
-      result['status']  = "FAIL"
-      result['message'] = "Virtual account already exists"
-      return (200, result)
-      
-    if modify is True and r is None:
-      result['status']  = "FAIL"
-      result['message'] = "Virtual account does not exist"
-      return (200, result)
+    return None
+
+
+  def _make_changes(self, data, result):
+    # Builds the attributes to write from the request; owner and recipients
+    # are only included when they are given. Returns None with the failure 
+    # filled in result if the request is not valid.
+    changes = {
+      'virtualemail': data['virtualemail'].lower(),
+      'vmail_domain': data['virtualemail'].split('@')[1].lower()
+    }
 
     if 'owner' in data:
       # allow bypassing the check by giving an empty list in config
-      owner_domain_ok = (len(self.owner_domains) == 0)
-      for _domain in self.owner_domains:
-        if re.search("@{}$".format(_domain), data['owner'], re.IGNORECASE):
-          owner_domain_ok = True
+      owner_domain_ok = (
+        len(self.owner_domains) == 0 or 
+        self.owner_domain_matcher.match(data['owner'])
+      )
         
       if owner_domain_ok == False:
         result['status']  = "FAIL"
         result['message'] = "Owner email address is not from an authorized domain"
-        return (200, result)
+        return None
         
-      _owner = data['owner'].lower()
+      changes['owner'] = data['owner'].lower()
+
+    if 'recipients' in data:
+      _recipients = self._parse_recipients(data['recipients'], result)
+      if _recipients is None:
+        return None
+
+      changes['recipients'] = json.dumps(_recipients).lower()
+      
+    if 'protected' in data and data['protected'] == True:
+      changes['protected'] = True
     else:
-      _owner = r['owner']
+      changes['protected'] = False
+      
+    if 'managed' in data and data['managed'] == False:
+      changes['managed'] = False
+    else:
+      changes['managed'] = True
+
+    return changes
 
-    rcpts = data['recipients'] if 'recipients' in data else r['recipients']
 
+  def _parse_recipients(self, rcpts, result):
     try:
       _rcpts = json.loads(rcpts)  
     except json.decoder.JSONDecodeError:
@@ -159,55 +486,72 @@ class Actions(object):
       if not self.validate_email(recipient):
         result['status']  = "FAIL"
         result['message'] = "Recipient {} is not a valid email address".format(recipient)
-        return (200, result)
+        return None
       
       # allow bypassing the check by giving an empty list in config
-      _domain_ok = (len(self.recipient_domains) == 0)
-      for _domain in self.recipient_domains:
-        if re.search("@{}$".format(_domain), recipient, re.IGNORECASE):
-          _domain_ok = True
+      _domain_ok = (
+        len(self.recipient_domains) == 0 or 
+        self.recipient_domain_matcher.match(recipient)
+      )
         
       if _domain_ok == False:
         result['status']  = "FAIL"
         result['message'] = "Recipient email address {} is not from an authorized domain; {}".format(recipient, self.recipient_domains)
-        return (200, result)
+        return None
 
       if recipient not in _recipients:
         _recipients.append(recipient)
 
-    if r is not None and 'protected' in r and r['protected'] != False:
-      result['status']  = "FAIL"
-      result['message'] = "Virtualemail is protected"
-      return (200, result)   
-      
-    if 'protected' in data and data['protected'] == True:
-      _protected = True
-    else:
-      _protected = False
-      
-    if 'managed' in data and data['managed'] == False:
-      _managed = False
-    else:
-      _managed = True
-    
-    d = {
-      'virtualemail': data['virtualemail'].lower(),
-      'owner':        _owner.lower(),
-      'recipients':   json.dumps(_recipients).lower(),
-      'protected':    _protected,
-      'managed':      _managed
-    }
-  
-    try:
-      ddb.put_item(self.ddb_tablename, d)
-    except Exception as e:
-      self.handle_exception(e, "writing to ddb in _action_add_or_modify()", text=json.dumps(event))
-      result['status']  = "FAIL"
-      result['message'] = "Internal error (AAOMWD)"
+    return _recipients
+
+
+  def _action_add_or_modify(self, event, action):
+    # Existence and protection are checked by the write itself, so that 
+    # concurrent requests for the same address can not both succeed
+    data   = self._get_data(event)
+
+    r = self._precheck_add_or_modify(data, action, self.get_apikeyid(event))
+    if r is not None:
+      return r
+
+    result = { 
+      "action":  action,
+      "virtualemail": data['virtualemail'] 
+    }      
+
+    changes = self._make_changes(data, result)
+    if changes is None:
       return (200, result)
-        
-    result['status']  = "OK"
-    return (200, result)  
+
+    for attempt in range(MAX_WRITE_ATTEMPTS):
+      try:
+        if action == 'add':
+          self._write_add(changes)
+        elif self._write_modify(changes) is False:
+          result['status']  = "FAIL"
+          result['message'] = self._condition_message(action, None)
+          return (200, result)
+
+        result['status']  = "OK"
+        return (200, result)  
+
+      except Exception as e:
+        failed, current = get_condition_failure(e)
+        if failed is False:
+          self.handle_exception(e, "writing to ddb in _action_add_or_modify()", text=json.dumps(event))
+          result['status']  = "FAIL"
+          result['message'] = "Internal error (AAOMWD)"
+          return (200, result)
+
+        message = self._condition_message(action, current)
+        if message is not None:
+          result['status']  = "FAIL"
+          result['message'] = message
+          return (200, result)
+
+    result['status']  = "FAIL"
+    result['message'] = "Virtual account is being modified concurrently"
+    return (200, result)
     
     
   #-------------------------------------------------------------------------#
@@ -216,6 +560,7 @@ class Actions(object):
   def get(self, event):
     data   = self._get_data(event)
     action = 'get'
+    apikeyid = self.get_apikeyid(event)
     
     r = self._require_params(['virtualemail'], data, action)
     if r is not None:
@@ -226,14 +571,14 @@ class Actions(object):
       "virtualemail": data['virtualemail'] 
     }
     
-    if self.validate_key_access(data['virtualemail']) is False:
+    if self.validate_key_access(data['virtualemail'], apikeyid) is False:
       result['status']  = "FAIL"
       result['message'] = "Virtualemail is not in an authorized domain"
       return (200, result)
       
     try:
       r = ddb.get_item(self.ddb_tablename, 'virtualemail', data['virtualemail'].lower())
-      result['result'] = r
+      result['result'] = self._public(r)
     except Exception as e:
       self.handle_exception(e, "get data from ddb in get()", text=json.dumps(event))
       result['status']  = "FAIL"
@@ -264,6 +609,7 @@ class Actions(object):
   def delete(self, event):
     data   = self._get_data(event)
     action = 'delete'
+    apikeyid = self.get_apikeyid(event)
 
     r = self._require_params(['virtualemail', 'owner'], data, action)
     if r is not None:
@@ -274,42 +620,355 @@ class Actions(object):
       "virtualemail": data['virtualemail'] 
     }          
     
-    if self.validate_key_access(data['virtualemail']) is False:
+    if self.validate_key_access(data['virtualemail'], apikeyid) is False:
       result['status']  = "FAIL"
       result['message'] = "Virtualemail is not in an authorized domain"
       return (200, result)    
-    
+
+    virtualemail = data['virtualemail'].lower()
+    owner = data['owner'].lower()
+
+    for attempt in range(MAX_WRITE_ATTEMPTS):
+      try:
+        self._write_delete(virtualemail, owner)
+        result['status']  = "OK"    
+        return (200, result)
+
+      except Exception as e:
+        failed, current = get_condition_failure(e)
+        if failed is False:
+          self.handle_exception(e, "delete data from ddb in delete()", text=json.dumps(event))
+          result['status']  = "FAIL"
+          result['message'] = "Internal error (DDD)"
+          return (200, result)
+
+        message = self._condition_message(action, current, owner)
+        if message is not None:
+          result['status']  = "FAIL"
+          result['message'] = message
+          return (200, result)
+
+    result['status']  = "FAIL"
+    result['message'] = "Virtual account is being modified concurrently"
+    return (200, result)
+
+
+  #-------------------------------------------------------------------------#
+
+
+  def _get_batch(self, data, param, action):
+    # Returns (entries, None) or (None, (code, result)) if the batch itself
+    # is not acceptable
+    if data is None or param not in data:
+      message = "Request missing parameter '{}'".format(param)
+    elif not isinstance(data[param], list) or len(data[param]) == 0:
+      message = "Invalid value for parameter '{}'".format(param)
+    elif len(data[param]) > MAX_BATCH_ITEMS:
+      message = "Too many entries in '{}', maximum is {}".format(param, MAX_BATCH_ITEMS)
+    else:
+      return (data[param], None)
+
+    result = {
+      "status":  "FAIL",
+      "action":  action,
+      "message": message
+    }
+    return (None, (400, result))
+
+
+  @staticmethod
+  def _batch_result(action, results):
+    status = "OK" if all([ x['status'] == "OK" for x in results ]) else "FAIL"
+    return (200, { "action": action, "status": status, "results": results })
+
+
+  def batch_get(self, event):
+    data   = self._get_data(event)
+    action = 'batch-get'
+    apikeyid = self.get_apikeyid(event)
+
+    virtualemails, r = self._get_batch(data, 'virtualemails', action)
+    if r is not None:
+      return r
+
+    results = []
+    keys = []
+    for virtualemail in virtualemails:
+      result = { 
+        "action":  'get',
+        "virtualemail": virtualemail 
+      }
+      results.append(result)
+
+      if not isinstance(virtualemail, str) or len(virtualemail) == 0:
+        result['status']  = "FAIL"
+        result['message'] = "Invalid value for parameter 'virtualemail'"
+      elif self.validate_key_access(virtualemail, apikeyid) is False:
+        result['status']  = "FAIL"
+        result['message'] = "Virtualemail is not in an authorized domain"
+      else:
+        keys.append(virtualemail.lower())
+
     try:
-      r = ddb.get_item(self.ddb_tablename, 'virtualemail', data['virtualemail'])
+      items = batch_get_items(ddb, self.ddb_tablename, 'virtualemail', keys)
     except Exception as e:
-      self.handle_exception(e, "get data from ddb in delete()", text=json.dumps(event))
+      self.handle_exception(e, "get data from ddb in batch_get()", text=json.dumps(event))
+      items = {}
+
+    for result in results:
+      if 'status' in result:
+        continue
+
+      key = result['virtualemail'].lower()
+      if key not in items:
+        result['status']  = "FAIL"
+        result['message'] = "Internal error (BGGD)"
+        continue
+
+      result['result'] = self._public(items[key])
+      result['status'] = "OK"
+
+    return self._batch_result(action, results)
+
+
+  def batch_add(self, event):
+    # Entries are validated one by one like in add() and written with the
+    # same conditional put, concurrently; the result of each entry is 
+    # returned in the same order as the entries
+    data   = self._get_data(event)
+    action = 'batch-add'
+    apikeyid = self.get_apikeyid(event)
+
+    entries, r = self._get_batch(data, 'items', action)
+    if r is not None:
+      return r
+
+    results = []
+    writes = []
+    seen = set()
+    for entry in entries:
+      try:
+        r = self._precheck_add_or_modify(entry, 'add', apikeyid)
+      except Exception:
+        # Malformed entries fail alone instead of failing the whole batch
+        r = (400, { "status": "FAIL", "action": 'add', "message": "Invalid entry" })
+
+      if r is not None:
+        results.append(r[1])
+        continue
+
+      result = { 
+        "action":  'add',
+        "virtualemail": entry['virtualemail'] 
+      }
+      results.append(result)
+
+      key = entry['virtualemail'].lower()
+      if key in seen:
+        result['status']  = "FAIL"
+        result['message'] = "Virtualemail is given more than once in the request"
+        continue
+
+      seen.add(key)
+      try:
+        d = self._make_changes(entry, result)
+      except Exception:
+        # e.g. a recipients list instead of a string, or an owner that is
+        # not a string
+        result['status']  = "FAIL"
+        result['message'] = "Invalid entry"
+        continue
+
+      if d is not None:
+        writes.append((d, result))
+
+    def write(x):
+      d, result = x
+      try:
+        self._write_add(d)
+        result['status']  = "OK"
+      except Exception as e:
+        result['status']  = "FAIL"
+        if get_condition_failure(e)[0] is True:
+          result['message'] = "Virtual account already exists"
+          return
+        self.handle_exception(e, "writing to ddb in batch_add()", text=json.dumps(d))
+        result['message'] = "Internal error (BAWD)"
+
+    if len(writes) > 0:
+      with ThreadPoolExecutor(max_workers=min(BATCH_WRITE_CONCURRENCY, len(writes))) as executor:
+        list(executor.map(write, writes))
+
+    return self._batch_result(action, results)
+
+
+  #-------------------------------------------------------------------------#
+
+
+  @staticmethod
+  def _encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+  @staticmethod
+  def _decode_cursor(cursor):
+    return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+
+
+  def _get_page_query(self, data, action, keyname, value):
+    # Returns (query, None) with the key condition, limit and start key of
+    # a paginated query or (None, (code, result)) if they are not valid
+    limit = data['limit'] if 'limit' in data else MAX_LIST_LIMIT
+    if type(limit) is not int or limit < 1 or limit > MAX_LIST_LIMIT:
+      result = {
+        "status":  "FAIL",
+        "action":  action,
+        "message": "Invalid value for parameter 'limit'"
+      }
+      return (None, (400, result))
+
+    query = {
+      'KeyConditionExpression':    '#k = :v',
+      'ExpressionAttributeNames':  { '#k': keyname },
+      'ExpressionAttributeValues': { ':v': value },
+      'Limit':                     limit
+    }
+
+    if 'cursor' in data and data['cursor'] is not None:
+      try:
+        start = self._decode_cursor(data['cursor'])
+        # A cursor is only valid for the query it was returned for
+        if not isinstance(start, dict) or start.get(keyname) != value:
+          raise ValueError("Cursor does not match the query")
+      except Exception:
+        result = {
+          "status":  "FAIL",
+          "action":  action,
+          "message": "Invalid value for parameter 'cursor'"
+        }
+        return (None, (400, result))
+      query['ExclusiveStartKey'] = start
+
+    return (query, None)
+
+
+  def list(self, event):
+    # Lists the addresses of an owner or a domain from a global secondary
+    # index one page at a time; the cursor of the response is passed back 
+    # as is to get the next page and is null on the last page
+    data   = self._get_data(event)
+    action = 'list'
+    apikeyid = self.get_apikeyid(event)
+
+    params = [ x for x in LIST_INDEXES if data is not None and x in data ]
+    if len(params) != 1:
+      result = {
+        "status":  "FAIL",
+        "action":  action,
+        "message": "Request must have exactly one of parameters {}".format(
+          ", ".join([ "'{}'".format(x) for x in LIST_INDEXES ])
+        )
+      }
+      return (400, result)
+
+    param = params[0]
+    r = self._require_params([param], data, action)
+    if r is not None:
+      return r
+
+    index, keyname = LIST_INDEXES[param]
+    value = data[param].lower()
+
+    query, r = self._get_page_query(data, action, keyname, value)
+    if r is not None:
+      return r
+
+    query.update({
+      'IndexName':                 index,
+      'ProjectionExpression':      'virtualemail, #o, recipients, protected, managed',
+      'ExpressionAttributeNames':  { '#k': keyname, '#o': 'owner' }
+    })
+
+    result = { 
+      "action": action,
+      param:    data[param] 
+    }
+
+    if param == 'domain' and self.validate_key_access('list@' + value, apikeyid) is False:
       result['status']  = "FAIL"
-      result['message'] = "Internal error (DGD)"
+      result['message'] = "Domain is not an authorized domain"
       return (200, result)
-      
-    if r is None:
+
+    try:
+      response = ddb.get_table(self.ddb_tablename).table.query(**query)
+    except Exception as e:
+      self.handle_exception(e, "query ddb in list()", text=json.dumps(event))
       result['status']  = "FAIL"
-      result['message'] = "Virtual account does not exist"
+      result['message'] = "Internal error (LQD)"
       return (200, result)
-    
-    if r['owner'] != data['owner'].lower():
+
+    # Restricted api keys only see the addresses of their own domain
+    result['results'] = [ 
+      x for x in response['Items'] 
+      if self.validate_key_access(x['virtualemail'], apikeyid) is True 
+    ]
+
+    if 'LastEvaluatedKey' in response:
+      result['cursor'] = self._encode_cursor(response['LastEvaluatedKey'])
+    else:
+      result['cursor'] = None
+
+    result['status'] = "OK"
+    return (200, result)
+
+
+  #-------------------------------------------------------------------------#
+
+
+  def reverse(self, event):
+    # Lists the virtualemails that forward to a recipient from the reverse
+    # index, paginated like list()
+    data   = self._get_data(event)
+    action = 'reverse'
+    apikeyid = self.get_apikeyid(event)
+
+    r = self._require_params(['recipient'], data, action)
+    if r is not None:
+      return r
+
+    value = data['recipient'].lower()
+    query, r = self._get_page_query(data, action, 'recipient', value)
+    if r is not None:
+      return r
+
+    result = { 
+      "action":    action,
+      "recipient": data['recipient'] 
+    }
+
+    if len(self.ddb_tablename_reverse) == 0:
       result['status']  = "FAIL"
-      result['message'] = "Owner parameter does not match owner in database"
+      result['message'] = "Reverse index is not in use"
       return (200, result)
-      
-    if r['protected'] != False:
-      result['status']  = "FAIL"
-      result['message'] = "Virtual account is protected"
-      return (200, result)    
-      
+
     try:
-      ddb.delete_item(self.ddb_tablename, 'virtualemail', data['virtualemail'].lower())
+      response = ddb.get_table(self.ddb_tablename_reverse).table.query(**query)
     except Exception as e:
-      self.handle_exception(e, "delete data from ddb in delete()", text=json.dumps(event))
+      self.handle_exception(e, "query ddb in reverse()", text=json.dumps(event))
       result['status']  = "FAIL"
-      result['message'] = "Internal error (DDD)"
+      result['message'] = "Internal error (RQD)"
       return (200, result)
-    
-    result['status']  = "OK"    
-    return (200, result)
 
+    # Restricted api keys only see the addresses of their own domain
+    result['results'] = [ 
+      x['virtualemail'] for x in response['Items'] 
+      if self.validate_key_access(x['virtualemail'], apikeyid) is True 
+    ]
+
+    if 'LastEvaluatedKey' in response:
+      result['cursor'] = self._encode_cursor(response['LastEvaluatedKey'])
+    else:
+      result['cursor'] = None
+
+    result['status'] = "OK"
+    return (200, result)
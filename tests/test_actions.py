@@ -0,0 +1,101 @@
+#
+# API action tests against the in-process AWS fakes of the benchmarks
+# (benchmarks/fakes.py), no AWS access needed:
+#
+#   python3 -m pytest tests
+
+import json
+import os
+import sys
+
+import pytest
+
+_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(_root, 'benchmarks'))
+sys.path.insert(0, os.path.join(_root, 'lambda', 'functions'))
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-west-1')
+os.environ.setdefault('sns_admin', 'arn:aws:sns:eu-west-1:123456789012:admin')
+os.environ.setdefault('metrics_namespace', '')
+
+import fakes
+
+from anlogger import Logger
+from virtualmail.common import utils
+from virtualmail.vmapi.actions import Actions, Settings
+
+logger = Logger("virtualmail-test", 'INFO').get()
+
+
+def make_actions(reverse=''):
+  return Actions(Settings(
+    ddb_tablename          = 'addresses',
+    ddb_tablename_reverse  = reverse,
+    email_domains          = frozenset([ 'vmail.example.com' ]),
+    owner_domains          = [ 'example.com' ],
+    recipient_domains      = [ 'example.com' ],
+    restricted_access_keys = {}
+  ), logger)
+
+
+def make_event(resource, body):
+  return {
+    'resource':       resource,
+    'httpMethod':     'POST',
+    'body':           json.dumps(body),
+    'requestContext': { 'identity': { 'apiKeyId': 'test' } }
+  }
+
+
+@pytest.fixture
+def env(monkeypatch):
+  # Fresh fakes per test; admin reports are collected instead of sent
+  _fakes = fakes.install(keynames={ 'addresses': 'virtualemail' })
+  reports = []
+  monkeypatch.setattr(utils, 'handle_exception', lambda *args, **kwargs: reports.append(args))
+  return _fakes, reports
+
+
+def test_modify_missing_address_with_reverse_index(env):
+  _fakes, reports = env
+  actions = make_actions(reverse='reverse')
+
+  code, result = actions.modify(make_event('/modify', {
+    'virtualemail': 'missing@vmail.example.com',
+    'owner':        'new.owner@example.com'
+  }))
+
+  assert code == 200
+  assert result['status'] == "FAIL"
+  assert result['message'] == "Virtual account does not exist"
+  assert reports == []
+
+
+def test_batch_add_with_malformed_entries(env):
+  _fakes, reports = env
+  actions = make_actions()
+
+  code, result = actions.batch_add(make_event('/batch-add', { 'items': [
+    {
+      'virtualemail': 'valid@vmail.example.com',
+      'owner':        'owner@example.com',
+      'recipients':   'one@example.com, two@example.com'
+    },
+    {
+      'virtualemail': 'list@vmail.example.com',
+      'owner':        'owner@example.com',
+      'recipients':   [ 'one@example.com' ]
+    },
+    {
+      'virtualemail': 'number@vmail.example.com',
+      'owner':        42,
+      'recipients':   'one@example.com'
+    }
+  ]}))
+
+  assert code == 200
+  assert result['status'] == "FAIL"
+  assert [ x['status'] for x in result['results'] ] == [ "OK", "FAIL", "FAIL" ]
+  assert [ x.get('message') for x in result['results'][1:] ] == [ "Invalid entry", "Invalid entry" ]
+  assert list(_fakes.dynamodb.Table('addresses').items) == [ 'valid@vmail.example.com' ]
+  assert reports == []